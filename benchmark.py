@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Benchmarks for Python-Delicious
+
+Runs common workloads against a local mock del.icio.us (see mockdelicious.py)
+and reports the wall time, peak memory, number of requests and bytes received
+for each. Every benchmark runs in a fresh process so that peak memory is not
+affected by those run before it.
+
+Usage: python benchmark.py [--posts N] [--latency S] [benchmark ...]
+"""
+
+import os
+import sys
+import subprocess
+import time
+import urllib2
+import resource
+
+import delicious
+import mockdelicious
+
+# The benchmarks run by default, in order.
+BENCHMARKS = ["full", "full-compact", "iterposts", "table", "resync", \
+              "bulk-add", "tags"]
+
+
+def _stats(api):
+    """Return the request and byte counts of the mock server at api"""
+    stats = {}
+    for line in urllib2.urlopen(api[:-len("/v1")] + "/stats").read().splitlines():
+        (name, value) = line.rsplit(" ", 1)
+        stats[name] = int(value)
+    return stats
+
+
+def _account(options, compact=0):
+    limiter = delicious.RateLimiter(rate=options.rate, burst=options.rate)
+    return delicious.open("benchmark", "benchmark", limiter=limiter, \
+            compact=compact)
+
+
+def _full(options):
+    _account(options).posts()
+
+def _fullcompact(options):
+    _account(options, compact=1).posts()
+
+def _iterposts(options):
+    for post in _account(options).iterposts():
+        pass
+
+def _table(options):
+    _account(options).posts_table()
+
+def _resyncsetup(options):
+    account = _account(options)
+    account.sync()
+    urllib2.urlopen(delicious.DELICIOUS_API[:-len("/v1")] + \
+            "/change?count=%d" % options.changes).read()
+    return account
+
+def _resync(options, account):
+    account.sync()
+
+def _bulkadd(options):
+    batch = _account(options).batch()
+    for i in range(options.adds):
+        batch.add("http://bulk.example.com/%d" % i, "Bulk %d" % i, \
+                tags="bulk benchmark")
+    batch.run()
+
+def _tags(options):
+    account = _account(options)
+    account.tags()
+    account.bundle("benchmark", "tag1 tag2 tag3")
+    account.bundles()
+    account.rename_tag("tag4", "renamed")
+    account.tags()
+
+# Each benchmark is a function of the options, timed after its setup function
+# (if any) has run and been passed what the setup returned.
+_functions = {"full": (None, _full), "full-compact": (None, _fullcompact), \
+              "iterposts": (None, _iterposts), "table": (None, _table), \
+              "resync": (_resyncsetup, _resync), "bulk-add": (None, _bulkadd), \
+              "tags": (None, _tags)}
+
+
+def run(name, options):
+    """Run one benchmark in this process and return its measurements"""
+    (setup, function) = _functions[name]
+    args = (options,)
+    if setup:
+        args = (options, setup(options))
+    before = _stats(delicious.DELICIOUS_API)
+    start = time.time()
+    function(*args)
+    elapsed = time.time() - start
+    after = _stats(delicious.DELICIOUS_API)
+
+    # ru_maxrss is in kilobytes on Linux but bytes on Mac OS X.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak / 1024
+    return {"name": name, "seconds": elapsed, "peak": peak / 1024.0, \
+            "requests": after["requests"] - before["requests"], \
+            "bytes": after["bytes"] - before["bytes"]}
+
+
+def main(args):
+    from optparse import OptionParser, SUPPRESS_HELP
+    parser = OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("--posts", type="int", default=10000, \
+            help="number of posts in the mock account")
+    parser.add_option("--latency", type="float", default=0, \
+            help="seconds added to every response")
+    parser.add_option("--throttle", type="int", default=0, \
+            help="refuse every Nth request with a 503")
+    parser.add_option("--rate", type="float", default=1000, \
+            help="requests per second allowed by the rate limiter")
+    parser.add_option("--changes", type="int", default=30, \
+            help="posts changed before a re-sync")
+    parser.add_option("--adds", type="int", default=200, \
+            help="posts added by bulk-add")
+    parser.add_option("--no-gzip", action="store_false", default=1, dest="gzip")
+    parser.add_option("--api", help=SUPPRESS_HELP)
+    (options, names) = parser.parse_args(args)
+    names = names or BENCHMARKS
+    for name in names:
+        if not _functions.has_key(name):
+            parser.error("unknown benchmark %s (choose from %s)" \
+                    % (name, ", ".join(BENCHMARKS)))
+
+    # Child processes are given the mock server and run a single benchmark.
+    if options.api:
+        delicious.DELICIOUS_API = options.api
+        result = run(names[0], options)
+        print result["seconds"], result["peak"], result["requests"], \
+                result["bytes"]
+        return
+
+    print "Starting mock server with %d posts..." % options.posts
+    server = mockdelicious.start(options.posts, latency=options.latency, \
+            throttle=options.throttle, retryafter=0, gzip=options.gzip)
+    print "%-14s %10s %10s %9s %12s" % ("benchmark", "seconds", "peak MB", \
+            "requests", "bytes")
+    for name in names:
+        command = [sys.executable, os.path.abspath(__file__), \
+                "--api", server.url] + \
+                [arg for arg in args if arg not in names] + [name]
+        child = subprocess.Popen(command, stdout=subprocess.PIPE)
+        (seconds, peak, requests, received) = child.communicate()[0].split()
+        print "%-14s %10.3f %10.1f %9d %12d" % (name, float(seconds), \
+                float(peak), int(requests), int(received))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -15,10 +15,6 @@ __author__ = "Paul Mucur <http://mucur.name/>"
 #TODO:
 #   Should text be properly escaped for XML? Or that not this module's
 #       responsibility?
-#   Create test suite
-#   Gzip support - but the API does not yet support it
-#   Use Etags and Last-Modified to make requests more efficient - but the API
-#       does not yet support it
 
 _debug = 0
 
@@ -28,10 +24,32 @@ USER_AGENT = "Python-Delicious/%s +http://github.com/mudge/python-delicious" % _
 
 import urllib
 import urllib2
+import urlparse
+import httplib
+import socket
+import base64
+import os
 import sys
 import re
 import time
+import calendar
+import math
+import bisect
+import heapq
+import array
+import zlib
+import random
+import rfc822
+import threading
+import weakref
+import Queue
+import StringIO
+import codecs
+import HTMLParser
+import htmlentitydefs
+from xml.sax.saxutils import escape
 from xml.dom import minidom
+from xml.parsers import expat
 try:
     StringTypes = basestring
 except:
@@ -58,18 +76,59 @@ try:
     import datetime
 except:
     datetime = None
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import json
+except ImportError:
+    try:
+        # Python 2.5 and earlier need the separate simplejson module
+        import simplejson as json
+    except ImportError:
+        json = None
+try:
+    import sqlite3
+except ImportError:
+    try:
+        # Python 2.4 and earlier need the separate pysqlite module
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
 
 
 # The URL of the del.icio.us API as it will be changing shortly.
 DELICIOUS_API = "https://api.del.icio.us/v1"
 
-def open(username, password):
+# The number of bytes read from a response at a time when parsing it
+# incrementally.
+_chunksize = 16384
+
+# Responses to reads are kept for revalidation up to this many bytes (as
+# received) each, with only the most recently used few kept per account.
+_storedsize = 262144
+_storedcount = 16
+
+def open(username, password, cache=None, limiter=None, staleness=None, \
+        compact=0, outbox=None):
     """Open a connection to a del.icio.us account"""
-    return DeliciousAccount(username, password)
+    return DeliciousAccount(username, password, cache, limiter, staleness, \
+            compact, outbox)
 
-def connect(username, password):
+def connect(username, password, cache=None, limiter=None, staleness=None, \
+        compact=0, outbox=None):
     """Open a connection to a del.icio.us account"""
-    return open(username, password)
+    return open(username, password, cache, limiter, staleness, compact, \
+            outbox)
 
 
 # Custom exceptions
@@ -110,6 +169,1781 @@ class DateParamsError(DeliciousError):
     '''Date params error'''
     pass
 
+
+# Helper functions
+
+def _iterparse(response, tagname):
+    """Yield the attributes of each `tagname` element in an XML response.
+
+    The response is read and fed to the parser in chunks so that each
+    element is available as soon as it is closed and the whole document
+    never has to be held in memory.
+
+    """
+    elements = []
+    def start_element(name, attrs):
+        if name == tagname:
+            elements.append(attrs)
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    while 1:
+        chunk = response.read(_chunksize)
+        parser.Parse(chunk, not chunk)
+        for attrs in elements:
+            yield attrs
+        del elements[:]
+        if not chunk:
+            break
+
+class _CountingReader:
+    """Wrap an HTTP response, reporting the number of bytes read from it"""
+
+    def __init__(self, response, callback):
+        self.response = response
+        self.callback = callback
+
+    def read(self, *args):
+        data = self.response.read(*args)
+        self.callback(len(data))
+        return data
+
+    def close(self):
+        self.response.close()
+
+class _TimingReader:
+    """Wrap an HTTP response, adding the time and bytes read to an event"""
+
+    def __init__(self, response, event):
+        self.response = response
+        self.event = event
+
+    def read(self, *args):
+        start = time.time()
+        data = self.response.read(*args)
+        self.event["download"] += time.time() - start
+        self.event["bytes"] += len(data)
+        return data
+
+    def close(self):
+        self.response.close()
+
+class _RecordingReader:
+    """Wrap a response, passing its whole body to a callback once read
+
+    A body longer than `limit` bytes is not kept; the callback is passed None
+    as soon as it is known to be too long.
+
+    """
+
+    def __init__(self, response, callback, limit):
+        self.response = response
+        self.callback = callback
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+
+    def read(self, *args):
+        data = self.response.read(*args)
+        if self.chunks is not None:
+            self.size += len(data)
+            if self.size > self.limit:
+                self.chunks = None
+                self.callback(None)
+                return data
+            self.chunks.append(data)
+            if not data or not args or args[0] < 0:
+                self.callback("".join(self.chunks))
+                self.chunks = None
+        return data
+
+    def close(self):
+        self.response.close()
+
+class _GzipReader:
+    """Wrap a gzip-encoded response, decompressing it as it is read"""
+
+    def __init__(self, response):
+        self.response = response
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.response.read(_chunksize)
+            if not chunk:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(chunk)
+        if size < 0:
+            (data, self.buffer) = (self.buffer, "")
+        else:
+            (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+    def close(self):
+        self.response.close()
+
+def _ymd(value):
+    """Format a date as a YYYY-MM-DD string for use in a query.
+
+    The date may be a string (which is used as is), a tuple or list whose
+    first three elements are the year, month and day, or a date or datetime.
+
+    """
+    if isinstance(value, ListType) or isinstance(value, TupleType):
+        return "-".join([str(x) for x in value[:3]])
+    elif datetime and (isinstance(value, datetime.datetime) or \
+            isinstance(value, datetime.date)):
+        return "-".join([str(value.year), str(value.month), str(value.day)])
+    return value
+
+def _addquery(url, description, extended="", tags=(), date=""):
+    """Return the query for adding a post to del.icio.us"""
+    query = {}
+    query["url"] = url
+    query ["description"] = description
+    if extended:
+        query["extended"] = extended
+    if tags and (isinstance(tags, TupleType) or isinstance(tags, ListType)):
+        query["tags"] = " ".join(tags)
+    elif tags and (StringTypes and isinstance(tags, StringTypes)) or \
+            (not StringTypes and (isinstance(tags, StringType) or \
+            isinstance(tags, UnicodeType))):
+        query["tags"] = tags
+
+    # This is a rather rudimentary way of parsing date strings into
+    # ISO8601 dates: if the date string is shorter than the required
+    # 20 characters then it is assumed that it is a partial date
+    # such as "2005-3-31" or "2005-3-31T20:00" and it is split into a
+    # list along non-numerals. Empty elements are then removed
+    # and then this is passed to the tuple/list case where
+    # the tuple/list is padded with necessary 0s and then formatted
+    # into an ISO8601 date string. This does not take into account
+    # time zones.
+    if date and ((StringTypes and isinstance(date, StringTypes)) or \
+            (not StringTypes and (isinstance(date, StringType) or \
+            isinstance(date, UnicodeType)))) and len(date) < 20:
+        date = [int(x) for x in re.split("\D", date) if x]
+    if date and (isinstance(date, ListType) or isinstance(date, TupleType)):
+        date = list(date)
+        if len(date) > 2 and len(date) < 6:
+            for i in range(6 - len(date)):
+                date.append(0)
+        query["dt"] = "%.4d-%.2d-%.2dT%.2d:%.2d:%.2dZ" % tuple(date)
+    elif date and (datetime and (isinstance(date, datetime.datetime) \
+            or isinstance(date, datetime.date))):
+        query["dt"] = "%.4d-%.2d-%.2dT%.2d:%.2d:%.2dZ" % date.utctimetuple()[:6]
+    elif date:
+        query["dt"] = date
+    return query
+
+def _urlencode(query):
+    """Encode a query, encoding any Unicode values as UTF-8"""
+    encoded = {}
+    for (name, value) in query.items():
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        encoded[name] = value
+    return urllib.urlencode(encoded)
+
+def _bundlequery(bundle, tags):
+    """Return the query for bundling a set of tags together"""
+    query = {}
+    query["bundle"] = bundle
+    if tags and (isinstance(tags, TupleType) or isinstance(tags, ListType)):
+        query["tags"] = " ".join(tags)
+    elif tags and isinstance(tags, StringTypes):
+        query["tags"] = tags
+    return query
+
+def _postdict(attrs):
+    """Turn the attributes of a post element into a post dictionary"""
+    postdict = {}
+    for (name, value) in attrs.items():
+        if name == u"tag":
+            name = u"tags"
+            value = value.split(" ")
+        if name == u"time":
+            postdict[u"time_parsed"] = time.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+        postdict[name] = value
+    return postdict
+
+
+# Compact posts
+
+def _unparsed(post):
+    """Return a post as a dictionary without its parsed time
+
+    The parsed time follows from the time, so compact posts are not made to
+    parse it just to be copied, compared or stored.
+
+    """
+    return dict([(key, post[key]) for key in post.keys() \
+            if key != u"time_parsed"])
+
+class Post(object):
+    """A compact alternative to the dictionaries returned by posts()
+
+    Posts store their fields in slots rather than a dictionary, share their
+    tag names with the other posts in the same PostList and only parse their
+    time when `time_parsed` is first used. They support the same dictionary
+    syntax, e.g. post["href"], and compare equal to the equivalent
+    dictionary, although their tags are a tuple rather than a list.
+
+    """
+
+    __slots__ = ("href", "description", "extended", "hash", "tags", "time", \
+            "others", "_time_parsed", "_extra")
+
+    def __init__(self, attrs=None):
+        self.href = self.description = self.hash = self.time = self.tags = None
+        self.extended = self.others = self._time_parsed = self._extra = None
+        if attrs:
+            self.update(attrs)
+
+    def _gettimeparsed(self):
+        if self._time_parsed is None and self.time:
+            self._time_parsed = time.strptime(self.time, "%Y-%m-%dT%H:%M:%SZ")
+        return self._time_parsed
+
+    time_parsed = property(_gettimeparsed)
+
+    def __getitem__(self, key):
+        if key == u"time_parsed" and self.time:
+            return self._gettimeparsed()
+        if key in Post.__slots__ and key[0] != "_":
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        elif self._extra and self._extra.has_key(key):
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == u"tag":
+            key = u"tags"
+            value = value.split(" ")
+        if key == u"tags":
+            value = tuple(value)
+        if key == u"time":
+            self._time_parsed = None
+        if key == u"time_parsed":
+            self._time_parsed = value
+        elif key in Post.__slots__ and key[0] != "_":
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def keys(self):
+        keys = [unicode(key) for key in Post.__slots__ \
+                if key[0] != "_" and getattr(self, key) is not None]
+        if self.time:
+            keys.append(u"time_parsed")
+        if self._extra:
+            keys.extend(self._extra.keys())
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def has_key(self, key):
+        try:
+            self[key]
+            return 1
+        except KeyError:
+            return 0
+
+    __contains__ = has_key
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, other):
+        for (key, value) in other.items():
+            self[key] = value
+
+    def clear(self):
+        Post.__init__(self)
+
+    def __eq__(self, other):
+        if not hasattr(other, "items"):
+            return False
+
+        # The parsed time follows from the time so it is not compared (and
+        # so not parsed needlessly).
+        mine = _unparsed(self)
+        theirs = _unparsed(other)
+        if theirs.has_key(u"tags"):
+            theirs[u"tags"] = tuple(theirs[u"tags"])
+        return mine == theirs
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "Post(%r)" % dict(self.items())
+
+
+# Columnar posts
+
+class _StringColumn:
+    """A dictionary-encoded column of strings
+
+    Each distinct string is stored once in `values` and each row holds the
+    index of its string in the array `ids`.
+
+    """
+
+    def __init__(self):
+        self.values = []
+        self.ids = array.array("l")
+        self.__index = {}
+
+    def append(self, value):
+        id = self.__index.get(value)
+        if id is None:
+            id = self.__index[value] = len(self.values)
+            self.values.append(value)
+        self.ids.append(id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        return self.values[self.ids[row]]
+
+class PostTable:
+    """Posts stored column by column for analysing many posts at once
+
+    `time` is an array of the time of each post in seconds since the epoch.
+    `href`, `description`, `extended` and `domain` (the host name of the
+    URL) are dictionary-encoded: each has a list of distinct `values` and
+    an array of `ids` into it. Tags are stored in compressed sparse rows:
+    the tags of row i are the `tagnames` indexed by
+    tag_ids[tag_offsets[i]:tag_offsets[i + 1]].
+
+    """
+
+    def __init__(self, posts=()):
+        self.time = array.array("l")
+        self.href = _StringColumn()
+        self.description = _StringColumn()
+        self.extended = _StringColumn()
+        self.domain = _StringColumn()
+        self.tagnames = []
+        self.tag_offsets = array.array("l", [0])
+        self.tag_ids = array.array("l")
+        self.__tagids = {}
+        for post in posts:
+            self.append(post)
+
+    def append(self, post):
+        """Add a post dictionary (or the attributes of a post element)"""
+        value = post.get(u"time")
+        if value:
+            self.time.append(calendar.timegm((int(value[0:4]), \
+                    int(value[5:7]), int(value[8:10]), int(value[11:13]), \
+                    int(value[14:16]), int(value[17:19]), 0, 0, 0)))
+        else:
+            self.time.append(0)
+        href = post.get(u"href", u"")
+        self.href.append(href)
+        self.description.append(post.get(u"description", u""))
+        self.extended.append(post.get(u"extended", u""))
+        self.domain.append(urlparse.urlsplit(href)[1].lower())
+        tags = post.get(u"tags")
+        if tags is None:
+            tags = post.get(u"tag", u"").split(" ")
+        for tag in tags:
+            if not tag:
+                continue
+            id = self.__tagids.get(tag)
+            if id is None:
+                id = self.__tagids[tag] = len(self.tagnames)
+                self.tagnames.append(tag)
+            self.tag_ids.append(id)
+        self.tag_offsets.append(len(self.tag_ids))
+
+    def __len__(self):
+        return len(self.time)
+
+    def tags(self, row):
+        """Return the tag names of a row"""
+        return [self.tagnames[id] for id in \
+                self.tag_ids[self.tag_offsets[row]:self.tag_offsets[row + 1]]]
+
+    def to_columns(self, usenumpy=None):
+        """Return a dictionary of every column
+
+        The arrays are NumPy int64 arrays if `usenumpy` is true or, by
+        default, whenever NumPy is installed; otherwise they are the arrays
+        held by the table. String columns are given as `<name>_ids` and
+        `<name>_values`.
+
+        """
+        if usenumpy is None:
+            usenumpy = numpy is not None
+        elif usenumpy and numpy is None:
+            raise DeliciousError("NumPy is not installed")
+        def convert(column):
+            if usenumpy:
+                return numpy.frombuffer(column, dtype="i%d" \
+                        % column.itemsize).astype(numpy.int64)
+            return column
+        columns = {"time": convert(self.time), "tagnames": self.tagnames, \
+                "tag_offsets": convert(self.tag_offsets), \
+                "tag_ids": convert(self.tag_ids)}
+        for name in ("href", "description", "extended", "domain"):
+            column = getattr(self, name)
+            columns[name + "_ids"] = convert(column.ids)
+            columns[name + "_values"] = column.values
+        return columns
+
+
+# Indexed lists used to store content inside the class dictionary
+
+class IndexedList(ListType):
+    """A list of dictionaries indexed by one of their keys
+
+    Appending a dictionary whose key is already in the list updates the
+    existing dictionary in place rather than adding a duplicate, so merging
+    new results costs a single lookup per item. Use append(), extend() and
+    remove() to change the list so that the index is kept up to date.
+    remove() moves the last dictionary into the place of the one removed
+    rather than shifting every dictionary after it.
+
+    """
+
+    def __init__(self, key, items=()):
+        ListType.__init__(self)
+        self.key = key
+        self._index = {}
+        self._positions = {}
+        self.extend(items)
+
+    def __contains__(self, item):
+        if isinstance(item, dict) or isinstance(item, Post):
+            return self._index.get(item.get(self.key)) == item
+        return self._index.has_key(item)
+
+    def get(self, key, default=None):
+        """Return the dictionary with the given key"""
+        return self._index.get(key, default)
+
+    def append(self, item):
+        """Add a dictionary or update the one with the same key"""
+        existing = self._index.get(item.get(self.key))
+        if existing is None:
+            self._positions[item.get(self.key)] = len(self)
+            ListType.append(self, item)
+            self._index[item.get(self.key)] = item
+            self._added(item)
+        elif existing is not item and existing != item:
+            self._removed(existing)
+            existing.clear()
+            existing.update(item)
+            self._added(existing)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def remove(self, item):
+        """Remove a dictionary (or the dictionary with the given key)"""
+        if isinstance(item, dict) or isinstance(item, Post):
+            item = item.get(self.key)
+        existing = self._index.pop(item)
+        self._removed(existing)
+
+        # The positions are found again if the list has been reordered.
+        i = self._positions.pop(item, None)
+        if i is None or i >= len(self) or self[i] is not existing:
+            self._positions = {}
+            for (position, other) in enumerate(self):
+                self._positions[other.get(self.key)] = position
+            i = self._positions.pop(item)
+        last = ListType.pop(self)
+        if i < len(self):
+            self[i] = last
+            self._positions[last.get(self.key)] = i
+
+    def _added(self, item):
+        pass
+
+    def _removed(self, item):
+        pass
+
+class PostList(IndexedList):
+    """A list of posts indexed by URL, tag and day"""
+
+    def __init__(self, posts=()):
+        self._bytag = {}
+        self._bydate = {}
+
+        # The full-text index and tag co-occurrences are only built once they
+        # are first used.
+        self._search = None
+        self._related = None
+
+        # Tag names shared between the compact posts in the list so that each
+        # distinct tag is only stored once however many posts use it.
+        self._tagnames = {}
+        IndexedList.__init__(self, u"href", posts)
+
+    def search(self, query, limit=None):
+        """Return the posts matching a query, best first
+
+        See SearchIndex for the query syntax.
+
+        """
+        if self._search is None:
+            self._search = SearchIndex(self)
+        scores = self._search.search(query, self._index).iteritems()
+        rank = lambda (href, score): (score, href)
+        if limit:
+            scores = heapq.nlargest(limit, scores, rank)
+        else:
+            scores = list(scores)
+            scores.sort(key=rank, reverse=True)
+        return [self._index[href] for (href, score) in scores]
+
+    def related_tags(self, tag, n=10):
+        """Return up to n tags most often used with a tag"""
+        if self._related is None:
+            self._related = TagCooccurrence(self)
+        return self._related.related(tag, n)
+
+    def suggest_tags(self, url_or_tags, n=10):
+        """Return up to n tags suggested for a URL or a set of tags"""
+        if self._related is None:
+            self._related = TagCooccurrence(self)
+        if StringTypes and isinstance(url_or_tags, StringTypes) and \
+                "://" in url_or_tags:
+            post = self._index.get(url_or_tags)
+            tags = ()
+            if post is not None:
+                tags = post.get(u"tags", ())
+            return self._related.suggest(tags, n, url_or_tags)
+        if StringTypes and isinstance(url_or_tags, StringTypes):
+            url_or_tags = url_or_tags.split()
+        return self._related.suggest(url_or_tags, n)
+
+    def days(self):
+        """Return a dictionary of days with the number of posts on each"""
+        days = {}
+        for (day, posts) in self._bydate.items():
+            days[day] = len(posts)
+        return days
+
+    def tagged(self, tag):
+        """Return the posts associated with a tag"""
+        return self._bytag.get(tag, {}).values()
+
+    def dated(self, date):
+        """Return the posts made on a date
+
+        The date may be given in any of the forms accepted by posts().
+
+        """
+        if not (StringTypes and isinstance(date, StringTypes)):
+            date = "%.4d-%.2d-%.2d" % tuple(time.strptime(_ymd(date), \
+                    "%Y-%m-%d")[:3])
+        return self._bydate.get(date, {}).values()
+
+    def _added(self, post):
+        if isinstance(post, Post) and post.tags:
+            tagnames = self._tagnames
+            post.tags = tuple([tagnames.setdefault(tag, tag) \
+                    for tag in post.tags])
+        href = post.get(u"href")
+        for tag in post.get(u"tags", ()):
+            self._bytag.setdefault(tag, {})[href] = post
+        if post.get(u"time"):
+            self._bydate.setdefault(post[u"time"][:10], {})[href] = post
+        if self._search is not None:
+            self._search.add(post)
+        if self._related is not None:
+            self._related.add(post)
+
+    def _removed(self, post):
+        href = post.get(u"href")
+        for tag in post.get(u"tags", ()):
+            posts = self._bytag.get(tag, {})
+            posts.pop(href, None)
+            if not posts:
+                self._bytag.pop(tag, None)
+        if post.get(u"time"):
+            posts = self._bydate.get(post[u"time"][:10], {})
+            posts.pop(href, None)
+            if not posts:
+                self._bydate.pop(post[u"time"][:10], None)
+        if self._search is not None:
+            self._search.remove(post)
+        if self._related is not None:
+            self._related.remove(post)
+
+def _indexedlist(key, items=(), compact=0):
+    """Return an indexed list suitable for the given attribute"""
+    if key == "posts":
+        if compact:
+            items = [Post(item) for item in items]
+        else:
+            for item in items:
+                if item.has_key(u"time") and not item.has_key(u"time_parsed"):
+                    item[u"time_parsed"] = time.strptime(item[u"time"], \
+                            "%Y-%m-%dT%H:%M:%SZ")
+        return PostList(items)
+    elif key == "dates":
+        return IndexedList(u"date", items)
+    return IndexedList(u"name", items)
+
+
+# Searching posts
+
+_words = re.compile(r"\w+", re.UNICODE)
+_queryterms = re.compile(r"\(|\)|[^\s()]+")
+
+class SearchIndex:
+    """An inverted index of the words in a set of posts
+
+    The words of each post's description, notes, URL and tags are indexed
+    with weights favouring tags and descriptions so that searching a large
+    account needs no network access and no scan of every post. Posts may
+    be added and removed at any time.
+
+    Queries are made of words, all of which must match. Words may be joined
+    with OR, negated with NOT (or a leading -) and grouped with parentheses;
+    a word ending in * matches any word it begins and tag:name only matches
+    posts with that tag. Matches are ranked by the weight of the words they
+    contain, with rarer words counting for more.
+
+    """
+
+    weights = ((u"tags", 3), (u"description", 2), (u"extended", 1), \
+            (u"href", 1))
+
+    def __init__(self, posts=()):
+        self.postings = {}
+        self.count = 0
+        self.__sorted = None
+        for post in posts:
+            self.add(post)
+
+    def __getstate__(self):
+        return (self.postings, self.count)
+
+    def __setstate__(self, state):
+        (self.postings, self.count) = state
+        self.__sorted = None
+
+    def __words(self, post):
+        """Return a dictionary of the words of a post and their weights"""
+        words = {}
+        for (field, weight) in self.weights:
+            value = post.get(field)
+            if not value:
+                continue
+            if field == u"tags":
+                for tag in value:
+                    if tag:
+                        words[u"tag:" + tag.lower()] = weight
+                value = u" ".join(value)
+            for word in _words.findall(value.lower()):
+                words[word] = words.get(word, 0) + weight
+        return words
+
+    def add(self, post):
+        """Index a post"""
+        href = post.get(u"href")
+        for (word, weight) in self.__words(post).items():
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = {}
+                self.__sorted = None
+            postings[href] = weight
+        self.count += 1
+
+    def remove(self, post):
+        """Remove a post, as it was indexed, from the index"""
+        href = post.get(u"href")
+        for word in self.__words(post).keys():
+            postings = self.postings.get(word)
+            if postings is not None:
+                postings.pop(href, None)
+                if not postings:
+                    del self.postings[word]
+                    self.__sorted = None
+        self.count -= 1
+
+    def search(self, query, universe=()):
+        """Return a dictionary of the URLs matching a query and their scores
+
+        Queries made up only of negated words match from the `universe` of
+        URLs given.
+
+        """
+        terms = _queryterms.findall(query)
+        terms.reverse()
+        return self.__or(terms, universe)
+
+    def __or(self, terms, universe):
+        scores = self.__and(terms, universe)
+        while terms and terms[-1] == "OR":
+            terms.pop()
+            for (href, score) in self.__and(terms, universe).items():
+                scores[href] = scores.get(href, 0) + score
+        return scores
+
+    def __and(self, terms, universe):
+        words = []
+        groups = []
+        excluded = []
+        while terms and terms[-1] not in ("OR", ")"):
+            term = terms.pop()
+            negated = 0
+            while term == "NOT" or term.startswith("-"):
+                negated = not negated
+                if term in ("NOT", "-"):
+                    if not terms:
+                        break
+                    term = terms.pop()
+                else:
+                    term = term[1:]
+            if term == "(":
+                scores = self.__or(terms, universe)
+                if terms and terms[-1] == ")":
+                    terms.pop()
+                if negated:
+                    excluded.append(scores)
+                else:
+                    groups.append(scores)
+            elif term in ("AND", "NOT", "-", ")"):
+                continue
+            elif negated and _words.search(term):
+                excluded.append(self.__lookup(term))
+            else:
+                words.extend(self.__lookup(term))
+
+        # Start from the rarest word and only look up the other words for
+        # the posts that it matches.
+        if words:
+            scores = self.__matches(words)
+        elif groups:
+            scores = groups.pop()
+        elif excluded:
+            scores = dict.fromkeys(universe, 0)
+        else:
+            return {}
+        for matches in groups:
+            for href in scores.keys():
+                if matches.has_key(href):
+                    scores[href] += matches[href]
+                else:
+                    del scores[href]
+        for matches in excluded:
+            if isinstance(matches, dict):
+                for href in matches:
+                    scores.pop(href, None)
+                continue
+            for href in scores.keys():
+                for alternatives in matches:
+                    if not self.__score(href, alternatives):
+                        break
+                else:
+                    del scores[href]
+        return scores
+
+    def __lookup(self, term):
+        """Return the postings and rarity of each word of a query term"""
+        term = term.lower()
+        prefix = term.endswith(u"*")
+        if term.startswith(u"tag:"):
+            words = [u"tag:" + term[4:].rstrip(u"*")]
+        else:
+            words = _words.findall(term)
+        lookups = []
+        for i in range(len(words)):
+            if prefix and i == len(words) - 1:
+                keys = self.__prefixed(words[i])
+            else:
+                keys = [words[i]]
+            alternatives = []
+            for key in keys:
+                docs = self.postings.get(key)
+                if docs:
+                    alternatives.append((docs, \
+                            math.log(1.0 + float(self.count) / len(docs))))
+            lookups.append(alternatives)
+        return lookups
+
+    def __score(self, href, alternatives):
+        score = 0
+        for (docs, rarity) in alternatives:
+            score = max(score, docs.get(href, 0) * rarity)
+        return score
+
+    def __matches(self, words):
+        """Return the scores of the posts matching every word"""
+        sizes = []
+        for alternatives in words:
+            size = 0
+            for (docs, rarity) in alternatives:
+                size += len(docs)
+            sizes.append((size, alternatives))
+        sizes.sort()
+        scores = {}
+        for (docs, rarity) in sizes[0][1]:
+            for (href, weight) in docs.iteritems():
+                if weight * rarity > scores.get(href, 0):
+                    scores[href] = weight * rarity
+        for (size, alternatives) in sizes[1:]:
+            for href in scores.keys():
+                score = self.__score(href, alternatives)
+                if score:
+                    scores[href] += score
+                else:
+                    del scores[href]
+        return scores
+
+    def __prefixed(self, prefix):
+        """Return the indexed words beginning with a prefix"""
+        if self.__sorted is None:
+            self.__sorted = self.postings.keys()
+            self.__sorted.sort()
+        words = []
+        for i in xrange(bisect.bisect_left(self.__sorted, prefix), \
+                len(self.__sorted)):
+            if not self.__sorted[i].startswith(prefix):
+                break
+            words.append(self.__sorted[i])
+        return words
+
+
+# Related tags
+
+class TagCooccurrence:
+    """Counts of how often each pair of tags is used on the same post
+
+    Only the pairs that are actually used together are stored so the
+    counts take space in proportion to the tags of the posts rather than to
+    the square of the number of tags. The tags used on each site are
+    counted too so that tags can be suggested for new URLs. Posts may be
+    added and removed at any time.
+
+    """
+
+    def __init__(self, posts=()):
+        self.counts = {}
+        self.pairs = {}
+        self.sites = {}
+        for post in posts:
+            self.add(post)
+
+    def __tags(self, post):
+        tags = {}
+        for tag in post.get(u"tags", ()):
+            if tag:
+                tags[tag] = 1
+        return tags.keys()
+
+    def __change(self, post, change):
+        tags = self.__tags(post)
+        site = _site(post.get(u"href", u""))
+        for tag in tags:
+            _increment(self.counts, tag, change)
+            _increment(self.sites.setdefault(site, {}), tag, change)
+            for other in tags:
+                if other != tag:
+                    _increment(self.pairs.setdefault(tag, {}), other, change)
+            if not self.pairs.get(tag, 1):
+                del self.pairs[tag]
+        if not self.sites.get(site, 1):
+            del self.sites[site]
+
+    def add(self, post):
+        """Count the tags of a post"""
+        self.__change(post, 1)
+
+    def remove(self, post):
+        """Stop counting the tags of a post, as they were counted"""
+        self.__change(post, -1)
+
+    def related(self, tag, n=10):
+        """Return up to n tags used with a tag, most often used first
+
+        Each is a dictionary of the tag's `name` and the `count` of posts
+        that it shares with the given tag.
+
+        """
+        pairs = self.pairs.get(tag, {}).iteritems()
+        pairs = heapq.nlargest(n, pairs, lambda (name, count): (count, name))
+        return [{u"name": name, u"count": count} for (name, count) in pairs]
+
+    def suggest(self, tags, n=10, url=None):
+        """Return up to n tags likely to be used with tags (or a URL)
+
+        Tags are scored by the chance that a post with each of the given
+        tags also has them and, if a URL is given, by how often they are
+        used on its site and whether they appear in it. Each is a dictionary
+        of the tag's `name` and its `score`.
+
+        """
+        scores = {}
+        for tag in tags:
+            count = float(self.counts.get(tag, 0))
+            for (other, together) in self.pairs.get(tag, {}).iteritems():
+                scores[other] = scores.get(other, 0) + together / count
+        if url:
+            site = self.sites.get(_site(url), {})
+            total = float(sum(site.values()) or 1)
+            for (tag, count) in site.iteritems():
+                scores[tag] = scores.get(tag, 0) + count / total
+            for word in _words.findall(url.lower()):
+                if self.counts.has_key(word):
+                    scores[word] = scores.get(word, 0) + 1
+        for tag in tags:
+            scores.pop(tag, None)
+        scores = heapq.nlargest(n, scores.iteritems(), \
+                lambda (name, score): (score, name))
+        return [{u"name": name, u"score": score} for (name, score) in scores]
+
+def _increment(counts, key, change):
+    """Add to a count in a dictionary, removing it if it reaches zero"""
+    count = counts.get(key, 0) + change
+    if count:
+        counts[key] = count
+    else:
+        counts.pop(key, None)
+
+def _site(url):
+    """Return the host name of a URL without any leading www."""
+    host = urlparse.urlsplit(url)[1].lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return host
+
+
+# HTTP connections
+
+class _PooledResponse:
+    """A response which hands its connection back to the pool once read"""
+
+    def __init__(self, pool, key, connection, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+        self.__pool = pool
+        self.__key = key
+        self.__connection = connection
+        self.__response = response
+
+    def read(self, *args):
+        data = self.__response.read(*args)
+        if self.__connection and self.__response.isclosed():
+            self.__pool.release(self.__key, self.__connection)
+            self.__connection = None
+        return data
+
+    def close(self):
+        # A connection cannot be reused until its response has been read so
+        # one abandoned part way through is closed instead.
+        if self.__connection:
+            self.__connection.close()
+            self.__connection = None
+        self.__response.close()
+
+class ConnectionPool:
+    """Persistent HTTP connections to del.icio.us for a single account
+
+    Connections are kept alive and reused between requests so that each
+    request costs a single round trip rather than a new TCP (and TLS)
+    handshake. Up to `size` idle connections are kept for each host and
+    each connection uses a socket timeout of `timeout` seconds (only once
+    connected on Python 2.5 and earlier). The account's credentials are
+    sent with every request.
+
+    """
+
+    def __init__(self, username, password, timeout=30, size=4):
+        self.timeout = timeout
+        self.size = size
+        self.__authorization = "Basic %s" % base64.encodestring("%s:%s" \
+                % (username, password)).replace("\n", "")
+        self.__idle = {}
+        self.__lock = threading.Lock()
+
+    def __checkout(self, key):
+        self.__lock.acquire()
+        try:
+            if self.__idle.get(key):
+                return self.__idle[key].pop()
+            return None
+        finally:
+            self.__lock.release()
+
+    def release(self, key, connection):
+        """Return a connection whose response has been read to the pool"""
+        self.__lock.acquire()
+        try:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                connection = None
+        finally:
+            self.__lock.release()
+        if connection:
+            connection.close()
+
+    def open(self, url, headers=None, timings=None):
+        """Request a URL, returning the response or raising urllib2.HTTPError
+
+        If a dictionary of `timings` is given, the seconds taken to connect
+        (zero for a kept-alive connection) and then to receive the first
+        byte of the response are stored in it as `connect` and `ttfb`, and
+        `reconnected` is set if a kept-alive connection had been closed.
+
+        """
+        (scheme, host, path, query, fragment) = urlparse.urlsplit(url)
+        if query:
+            path = "%s?%s" % (path, query)
+        key = (scheme, host)
+        requestheaders = {"User-Agent": USER_AGENT, \
+                "Authorization": self.__authorization}
+        if headers:
+            requestheaders.update(headers)
+        while 1:
+            connection = self.__checkout(key)
+            reused = connection is not None
+            start = time.time()
+            if not reused:
+                if scheme == "https":
+                    connectionclass = httplib.HTTPSConnection
+                else:
+                    connectionclass = httplib.HTTPConnection
+                try:
+                    connection = connectionclass(host, timeout=self.timeout)
+                    timeout = None
+                except TypeError:
+                    # Python 2.5 and earlier do not take a timeout, so only
+                    # the requests made once connected can time out.
+                    (connection, timeout) = (connectionclass(host), self.timeout)
+                connection.connect()
+                if timeout is not None:
+                    connection.sock.settimeout(timeout)
+            connected = time.time()
+            try:
+                connection.request("GET", path, headers=requestheaders)
+                response = connection.getresponse()
+                if timings is not None:
+                    timings["connect"] = connected - start
+                    timings["ttfb"] = time.time() - connected
+                break
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+
+                # The server may have closed an idle connection since it was
+                # last used, in which case the request is tried again.
+                if not reused:
+                    raise
+                if timings is not None:
+                    timings["reconnected"] = 1
+        response = _PooledResponse(self, key, connection, response)
+        if response.status != 200:
+            body = response.read()
+            raise urllib2.HTTPError(url, response.status, response.reason, \
+                    response.headers, StringIO.StringIO(body))
+        return response
+
+    def close(self):
+        """Close every idle connection"""
+        self.__lock.acquire()
+        try:
+            for idle in self.__idle.values():
+                for connection in idle:
+                    connection.close()
+            self.__idle = {}
+        finally:
+            self.__lock.release()
+
+
+# Rate limiting
+
+class RateLimiter:
+    """A token bucket limiting the rate of requests made to del.icio.us
+
+    Up to `burst` requests may be made at once, after which requests are
+    spaced so that no more than `rate` are made each second. A request that
+    is throttled by del.icio.us is retried up to `retries` times, waiting
+    for the time given by a Retry-After header or for an exponentially
+    increasing (and slightly randomised) delay starting at `backoff` seconds.
+
+    One limiter may be shared by any number of threads and accounts. If
+    `lockfile` is given, the state of the bucket is kept in that file so
+    that several processes on one host stay under the limit together. If
+    `parent` is given, every request must also wait for that limiter so
+    that many limiters can be kept under one overall limit.
+
+    """
+
+    def __init__(self, rate=1.0, burst=1, retries=5, backoff=2.0, \
+            maxbackoff=300.0, lockfile=None, parent=None):
+        if lockfile and not fcntl:
+            raise DeliciousError("The fcntl module is required for lock files")
+        self.rate = float(rate)
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.lockfile = lockfile
+        self.parent = parent
+        self.__tokens = float(burst)
+        self.__stamp = time.time()
+        self.__lock = threading.Lock()
+
+    def __update(self, change, drain=0):
+        """Refill the bucket, add `change` tokens and return the new total
+
+        The number of tokens is allowed to fall below zero so that each
+        caller reserves its place in the queue rather than polling. If
+        `drain` is true, any tokens left in the bucket are discarded first.
+
+        """
+        self.__lock.acquire()
+        try:
+            if not self.lockfile:
+                self.__tokens = self.__refill(self.__tokens, self.__stamp, \
+                        drain) + change
+                self.__stamp = time.time()
+                return self.__tokens
+            fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    try:
+                        (tokens, stamp) = [float(x) for x in os.read(fd, 64).split()]
+                    except ValueError:
+                        (tokens, stamp) = (float(self.burst), time.time())
+                    tokens = self.__refill(tokens, stamp, drain) + change
+                    os.lseek(fd, 0, 0)
+                    os.ftruncate(fd, 0)
+                    os.write(fd, "%r %r\n" % (tokens, time.time()))
+                    return tokens
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        finally:
+            self.__lock.release()
+
+    def __refill(self, tokens, stamp, drain):
+        tokens = min(float(self.burst), tokens + (time.time() - stamp) * self.rate)
+        if drain:
+            tokens = min(0, tokens)
+        return tokens
+
+    def acquire(self):
+        """Wait until a request may be made and return the time waited"""
+        tokens = self.__update(-1)
+        delay = 0
+        if tokens < 0:
+            delay = -tokens / self.rate
+            time.sleep(delay)
+        if self.parent:
+            delay += self.parent.acquire()
+        return delay
+
+    def throttled(self, attempt, retryafter=None):
+        """Note that a request was throttled and return the delay before retrying
+
+        The delay is taken out of the bucket so that every user of the
+        limiter backs off, not just the request that was throttled.
+
+        """
+        delay = min(self.maxbackoff, self.backoff * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        if retryafter:
+            try:
+                delay = float(retryafter)
+            except ValueError:
+                date = rfc822.parsedate_tz(retryafter)
+                if date:
+                    delay = max(0, rfc822.mktime_tz(date) - time.time())
+        self.__update(-delay * self.rate, 1)
+        if self.parent:
+            delay = max(delay, self.parent.throttled(attempt, retryafter))
+        return delay
+
+
+# Instrumentation
+
+class Metrics:
+    """Counters and latency histograms of requests made to del.icio.us
+
+    A Metrics object is a hook: append it to the hooks of any number of
+    accounts and it will count the requests, retries, reconnects, errors,
+    bytes and items of each API endpoint and record how long requests spent
+    waiting on the rate limiter, connecting, waiting for the first byte,
+    downloading and parsing in histograms with the given `buckets` (upper
+    bounds in seconds).
+
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, \
+            10.0, 30.0)
+    phases = ("waited", "connect", "ttfb", "download", "parse", "seconds")
+
+    def __init__(self, buckets=None):
+        if buckets:
+            self.buckets = tuple(buckets)
+        self.__endpoints = {}
+        self.__lock = threading.Lock()
+
+    def __call__(self, event):
+        self.__lock.acquire()
+        try:
+            endpoint = self.__endpoints.get(event["endpoint"])
+            if endpoint is None:
+                endpoint = {"requests": 0, "statuses": {}, "retries": 0, \
+                        "reconnects": 0, "errors": 0, "cached": 0, "bytes": 0, \
+                        "items": 0}
+                for phase in self.phases:
+                    endpoint[phase] = {"count": 0, "sum": 0.0, \
+                            "buckets": [0] * len(self.buckets)}
+                self.__endpoints[event["endpoint"]] = endpoint
+            endpoint["requests"] += 1
+            status = str(event["status"])
+            endpoint["statuses"][status] = endpoint["statuses"].get(status, 0) + 1
+            endpoint["retries"] += event["retries"]
+            endpoint["reconnects"] += event["reconnected"]
+            endpoint["errors"] += event["error"] is not None
+            endpoint["cached"] += event["cached"]
+            endpoint["bytes"] += event["bytes"]
+            endpoint["items"] += event["items"]
+            for phase in self.phases:
+                histogram = endpoint[phase]
+                histogram["count"] += 1
+                histogram["sum"] += event[phase]
+                for i in range(len(self.buckets)):
+                    if event[phase] <= self.buckets[i]:
+                        histogram["buckets"][i] += 1
+        finally:
+            self.__lock.release()
+
+    def as_dict(self):
+        """Return the metrics as a dictionary of dictionaries by endpoint
+
+        Each histogram is a dictionary of its `count`, `sum` and the
+        cumulative count of each of its `buckets`.
+
+        """
+        self.__lock.acquire()
+        try:
+            return pickle.loads(pickle.dumps(self.__endpoints, 2))
+        finally:
+            self.__lock.release()
+
+    def prometheus(self, prefix="delicious"):
+        """Return the metrics in the Prometheus text exposition format"""
+        endpoints = self.as_dict()
+        names = endpoints.keys()
+        names.sort()
+        lines = []
+        def counter(name, help, key):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s counter" % (prefix, name))
+            for endpoint in names:
+                lines.append("%s_%s{endpoint=\"%s\"} %s" % (prefix, name, \
+                        endpoint, endpoints[endpoint][key]))
+        lines.append("# HELP %s_requests_total Requests made to del.icio.us." % prefix)
+        lines.append("# TYPE %s_requests_total counter" % prefix)
+        for endpoint in names:
+            statuses = endpoints[endpoint]["statuses"].items()
+            statuses.sort()
+            for (status, count) in statuses:
+                lines.append("%s_requests_total{endpoint=\"%s\",status=\"%s\"} %d" \
+                        % (prefix, endpoint, status, count))
+        counter("retries_total", "Requests retried after being throttled.", \
+                "retries")
+        counter("reconnects_total", "Requests retried on a new connection " \
+                "after a kept-alive one was closed.", "reconnects")
+        counter("errors_total", "Requests that failed.", "errors")
+        counter("not_modified_total", "Responses reused as unmodified.", "cached")
+        counter("response_bytes_total", "Bytes of responses received.", "bytes")
+        counter("items_total", "Items parsed from responses.", "items")
+        lines.append("# HELP %s_request_seconds Time spent on each phase of " \
+                "requests." % prefix)
+        lines.append("# TYPE %s_request_seconds histogram" % prefix)
+        for endpoint in names:
+            for phase in self.phases:
+                histogram = endpoints[endpoint][phase]
+                labels = "endpoint=\"%s\",phase=\"%s\"" % (endpoint, phase)
+                for i in range(len(self.buckets)):
+                    lines.append("%s_request_seconds_bucket{%s,le=\"%s\"} %d" \
+                            % (prefix, labels, repr(self.buckets[i]), \
+                            histogram["buckets"][i]))
+                lines.append("%s_request_seconds_bucket{%s,le=\"+Inf\"} %d" \
+                        % (prefix, labels, histogram["count"]))
+                lines.append("%s_request_seconds_sum{%s} %r" % (prefix, \
+                        labels, histogram["sum"]))
+                lines.append("%s_request_seconds_count{%s} %d" % (prefix, \
+                        labels, histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+
+# Durable outbox
+
+# The error raised when each kind of change is refused.
+_changeerrors = {"add": AddError, "delete": DeleteError, "bundle": BundleError, \
+        "delete_bundle": DeleteBundleError, "rename_tag": RenameTagError}
+
+class Outbox:
+    """A local SQLite journal of changes waiting to be made to del.icio.us
+
+    Each change is stored before it is made so that none are lost if the
+    process stops or del.icio.us refuses requests for a while; an account
+    given an outbox makes its changes from it in the background and, when
+    next opened, makes any that were left. A change to a post or bundle
+    replaces any earlier change to the same post or bundle that has not
+    yet been started. Changes are kept, marked done or failed, until
+    purged. Several processes and accounts may share one file.
+
+    Changes being made are leased to the outbox that claimed them for
+    `lease` seconds at a time; only changes whose lease has run out (as
+    their process has stopped) are made again by another.
+
+    """
+
+    def __init__(self, path, timeout=30, lease=300):
+        if not sqlite3:
+            raise DeliciousError("The sqlite3 module is required for an outbox")
+        self.path = path
+        self.lease = lease
+        self.owner = "%s:%d:%x" % (socket.gethostname(), os.getpid(), id(self))
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, timeout, isolation_level=None, \
+                check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER " \
+                "PRIMARY KEY AUTOINCREMENT, username TEXT, operation TEXT, " \
+                "key TEXT, path TEXT, query BLOB, state TEXT, error TEXT, " \
+                "created REAL, owner TEXT, lease REAL)")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS outbox_state ON outbox " \
+                "(username, state, id)")
+
+        # Outboxes made before changes were leased lack the owner and lease.
+        columns = [row[1] for row in \
+                self.__db.execute("PRAGMA table_info(outbox)")]
+        for (column, type) in (("owner", "TEXT"), ("lease", "REAL")):
+            if column not in columns:
+                self.__db.execute("ALTER TABLE outbox ADD COLUMN %s %s" \
+                        % (column, type))
+
+    def __transaction(self, function, *args):
+        self.__lock.acquire()
+        try:
+            self.__db.execute("BEGIN IMMEDIATE")
+            try:
+                result = function(*args)
+            except:
+                self.__db.execute("ROLLBACK")
+                raise
+            self.__db.execute("COMMIT")
+            return result
+        finally:
+            self.__lock.release()
+
+    def put(self, username, operation, key, path, query):
+        """Record a change to make, returning its id"""
+        return self.__transaction(self.__put, username, operation, key, path, \
+                query)
+
+    def __put(self, username, operation, key, path, query):
+        if operation in ("add", "delete"):
+            self.__db.execute("DELETE FROM outbox WHERE username = ? AND " \
+                    "key = ? AND state = 'pending' AND operation IN " \
+                    "('add', 'delete')", (username, key))
+        elif operation in ("bundle", "delete_bundle"):
+            self.__db.execute("DELETE FROM outbox WHERE username = ? AND " \
+                    "key = ? AND state = 'pending' AND operation IN " \
+                    "('bundle', 'delete_bundle')", (username, key))
+        return self.__db.execute("INSERT INTO outbox (username, operation, " \
+                "key, path, query, state, created) VALUES (?, ?, ?, ?, ?, " \
+                "'pending', ?)", (username, operation, key, path, \
+                sqlite3.Binary(pickle.dumps(query, 2)), time.time())).lastrowid
+
+    def claim(self, username, limit=50):
+        """Lease up to `limit` changes waiting to be made and return them
+
+        Changes whose lease has run out are claimed along with pending
+        ones. Each is a tuple of its id, operation, key, API path and query.
+
+        """
+        return self.__transaction(self.__claim, username, limit)
+
+    def __claim(self, username, limit):
+        now = time.time()
+        rows = self.__db.execute("SELECT id, operation, key, path, query " \
+                "FROM outbox WHERE username = ? AND (state = 'pending' OR " \
+                "state = 'sending' AND (lease IS NULL OR lease < ?)) " \
+                "ORDER BY id LIMIT ?", (username, now, limit)).fetchall()
+        self.__db.executemany("UPDATE outbox SET state = 'sending', " \
+                "owner = ?, lease = ? WHERE id = ?", [(self.owner, \
+                now + self.lease, row[0]) for row in rows])
+        return [(id, operation, key, path, pickle.loads(str(query))) \
+                for (id, operation, key, path, query) in rows]
+
+    def renew(self, ids):
+        """Extend the lease of changes claimed by this outbox"""
+        self.__transaction(self.__db.executemany, "UPDATE outbox SET lease " \
+                "= ? WHERE id = ? AND owner = ? AND state = 'sending'", \
+                [(time.time() + self.lease, id, self.owner) for id in ids])
+
+    def finish(self, id, error=None):
+        """Mark a change as done or, if there was an error, as failed"""
+        state = "done"
+        if error:
+            state = "failed"
+        self.__transaction(self.__db.execute, "UPDATE outbox SET state = ?, " \
+                "error = ? WHERE id = ?", (state, error, id))
+
+    def release(self, id):
+        """Return a change that could not be made yet to the pending changes"""
+        self.__transaction(self.__db.execute, "UPDATE outbox SET state = " \
+                "'pending', owner = NULL, lease = NULL WHERE id = ? AND " \
+                "owner = ? AND state = 'sending'", (id, self.owner))
+
+    def recover(self, username):
+        """Return changes whose lease has run out to the pending changes"""
+        self.__transaction(self.__db.execute, "UPDATE outbox SET state = " \
+                "'pending', owner = NULL, lease = NULL WHERE username = ? AND " \
+                "state = 'sending' AND (lease IS NULL OR lease < ?)", \
+                (username, time.time()))
+
+    def count(self, username):
+        """Return the number of changes for a user that are not yet made"""
+        self.__lock.acquire()
+        try:
+            return self.__db.execute("SELECT COUNT(*) FROM outbox WHERE " \
+                    "username = ? AND state IN ('pending', 'sending')", \
+                    (username,)).fetchone()[0]
+        finally:
+            self.__lock.release()
+
+    def failures(self, username):
+        """Return the changes for a user that failed
+
+        Each is a dictionary of the change's id, operation, key and error.
+
+        """
+        self.__lock.acquire()
+        try:
+            return [{"id": id, "operation": operation, "key": key, \
+                    "error": error} for (id, operation, key, error) in \
+                    self.__db.execute("SELECT id, operation, key, error FROM " \
+                    "outbox WHERE username = ? AND state = 'failed' ORDER BY id", \
+                    (username,))]
+        finally:
+            self.__lock.release()
+
+    def purge(self, username=None):
+        """Forget changes that are done (for one user or every user)"""
+        if username is None:
+            self.__transaction(self.__db.execute, "DELETE FROM outbox WHERE " \
+                    "state = 'done'")
+        else:
+            self.__transaction(self.__db.execute, "DELETE FROM outbox WHERE " \
+                    "username = ? AND state = 'done'", (username,))
+
+    def close(self):
+        self.__db.close()
+
+class _OutboxDrainer(threading.Thread):
+    """Make the changes in an account's outbox as quickly as allowed
+
+    Only a weak reference to the account is held so that the drainer stops
+    once the account has been closed or is no longer used.
+
+    """
+
+    # Seconds to wait for changes before checking the outbox again, which
+    # also picks up changes left by processes that have stopped.
+    idle = 5
+
+    def __init__(self, account, username):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.account = weakref.ref(account)
+        self.outbox = account.outbox
+        self.limiter = account.limiter
+        self.username = username
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+
+        # The last exception raised while making changes, if any, and the
+        # seconds being waited before trying again.
+        self.error = None
+        self.backoff = 0
+
+    def stop(self):
+        """Stop once the change being made, if any, has been made"""
+        self.stopped.set()
+        self.wake.set()
+
+    def run(self):
+        delay = 0
+        while not self.stopped.isSet():
+            self.wake.clear()
+            account = self.account()
+            if account is None:
+                break
+            changes = []
+            transient = 0
+            try:
+                changes = self.outbox.claim(self.username)
+                if changes:
+                    transient = self.__make(account, changes)
+
+            # Anything unexpected (e.g. a locked outbox or a garbled
+            # response) is retried later rather than stopping the drainer.
+            except Exception, e:
+                self.error = e
+                self.__release(changes)
+                transient = 1
+            del account
+            if not changes and not transient:
+                self.wake.wait(self.idle)
+                continue
+
+            # Back off for longer each time del.icio.us cannot be reached.
+            if transient:
+                delay = min(max(delay * 2, self.limiter.backoff), \
+                        self.limiter.maxbackoff)
+                self.backoff = delay
+                self.stopped.wait(delay)
+            else:
+                delay = self.backoff = 0
+
+    def __make(self, account, changes):
+        """Make claimed changes in order, returning whether one must wait"""
+        batch = account.batch(self.limiter.retries)
+        for i in range(len(changes)):
+            (id, operation, key, path, query) = changes[i]
+            if self.stopped.isSet():
+                break
+            self.outbox.renew([change[0] for change in changes[i:]])
+            batch.changes.append((operation, key, path, query, \
+                    _changeerrors[operation]))
+            result = batch.run()[0]
+            if result["ok"]:
+                self.outbox.finish(id)
+            elif result["error"] is ThrottleError or \
+                    not issubclass(result["error"], DeliciousError) and \
+                    (result["status"] is None or result["status"] >= 500):
+                break
+            else:
+                self.outbox.finish(id, result["message"] or \
+                        result["error"].__name__)
+        else:
+            return 0
+
+        # Changes not made yet are left for later, in order.
+        self.__release(changes[i:])
+        return not self.stopped.isSet()
+
+    def __release(self, changes):
+        """Return claimed changes that have not been made to the outbox"""
+        try:
+            for change in changes:
+                self.outbox.release(change[0])
+        except Exception:
+            # Their lease will run out instead.
+            pass
+
+
+# Shared reads
+
+class ReadCache:
+    """Coalesces identical reads and keeps their results for a while
+
+    When several threads make the same read (e.g. tags() for one user) at
+    once, only the first makes a request; the others wait for and share its
+    result. If `ttl` is greater than zero results are also kept for `ttl`
+    seconds, up to `size` of them with the least recently used discarded
+    first. Results for a user are discarded when an account makes a change
+    for that user. One cache may be shared by any number of accounts.
+
+    """
+
+    def __init__(self, size=256, ttl=0):
+        self.size = size
+        self.ttl = ttl
+        self.__entries = {}
+        self.__inflight = {}
+        self.__generations = {}
+        self.__used = 0
+        self.__lock = threading.Lock()
+
+    def fetch(self, key, function, *args):
+        """Return the result for a key (a tuple starting with a username)
+
+        The result is calculated by calling function(*args) unless it is
+        held or already being calculated.
+
+        """
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get(key)
+            if entry and entry[0] > time.time():
+                self.__used += 1
+                self.__entries[key] = (entry[0], entry[1], self.__used)
+                return entry[1]
+            future = self.__inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.__inflight[key] = Future()
+                generation = self.__generations.get(key[0], 0)
+        finally:
+            self.__lock.release()
+        if not owner:
+            return future.result()
+        try:
+            value = function(*args)
+        except:
+            self.__lock.acquire()
+            try:
+                del self.__inflight[key]
+            finally:
+                self.__lock.release()
+            future._set(error=sys.exc_info())
+            raise
+        self.__lock.acquire()
+        try:
+            del self.__inflight[key]
+
+            # A result read while the user made a change may be out of date.
+            if self.ttl > 0 and generation == self.__generations.get(key[0], 0):
+                self.__used += 1
+                self.__entries[key] = (time.time() + self.ttl, value, self.__used)
+                while len(self.__entries) > self.size:
+                    oldest = min([(used, key) for (key, (expires, value, used)) \
+                            in self.__entries.items()])[1]
+                    del self.__entries[oldest]
+        finally:
+            self.__lock.release()
+        future._set(value)
+        return value
+
+    def invalidate(self, username):
+        """Discard every result held for a user"""
+        self.__lock.acquire()
+        try:
+            self.__generations[username] = self.__generations.get(username, 0) + 1
+            for key in self.__entries.keys():
+                if key[0] == username:
+                    del self.__entries[key]
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        """Discard every result held"""
+        self.__lock.acquire()
+        try:
+            for username in self.__generations.keys():
+                self.__generations[username] += 1
+            self.__entries = {}
+        finally:
+            self.__lock.release()
+
+
+# Persistent cache
+
+class DeliciousCache:
+    """A local SQLite file storing the content of del.icio.us accounts
+
+    Posts, tags, bundles and dates are stored along with the time of the
+    last update to the account that they correspond to so that they can be
+    reused by later processes for as long as the account is unchanged. Each
+    save happens in a single transaction so several processes (and several
+    accounts) may safely share one file.
+
+    """
+
+    def __init__(self, path, timeout=30):
+        if not sqlite3:
+            raise DeliciousError("The sqlite3 module is required for caching")
+        self.path = path
+        self.__lock = threading.Lock()
+
+        # Transactions are managed explicitly so that a list of posts is
+        # always read and written as a whole.
+        self.__db = sqlite3.connect(path, timeout, isolation_level=None, \
+                check_same_thread=False)
+        self.__db.execute("CREATE TABLE IF NOT EXISTS content (username TEXT, " \
+                "key TEXT, lastupdate TEXT, data BLOB, PRIMARY KEY (username, key))")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS posts (username TEXT, " \
+                "href TEXT, data BLOB, PRIMARY KEY (username, href))")
+
+    def load(self, username, key, lastupdate):
+        """Return the stored list for `key` if it matches `lastupdate`
+
+        None is returned if nothing has been stored or if the account has
+        been updated since it was.
+
+        """
+        self.__lock.acquire()
+        try:
+            self.__db.execute("BEGIN")
+            try:
+                row = self.__db.execute("SELECT lastupdate, data FROM content " \
+                        "WHERE username = ? AND key = ?", (username, key)).fetchone()
+                if not row or row[0] != lastupdate:
+                    return None
+                if key == "posts":
+                    return [pickle.loads(str(data)) for (data,) in self.__db.execute( \
+                            "SELECT data FROM posts WHERE username = ? ORDER BY rowid", \
+                            (username,))]
+                return pickle.loads(str(row[1]))
+            finally:
+                self.__db.execute("COMMIT")
+        finally:
+            self.__lock.release()
+
+    def save(self, username, key, items, lastupdate):
+        """Store a list of dictionaries (or a SearchIndex) for `key` as of `lastupdate`"""
+        self.__lock.acquire()
+        try:
+            self.__db.execute("BEGIN IMMEDIATE")
+            try:
+                if key == "posts":
+                    data = None
+                    self.__db.execute("DELETE FROM posts WHERE username = ?", \
+                            (username,))
+                    self.__db.executemany("INSERT INTO posts VALUES (?, ?, ?)", \
+                            [(username, post.get(u"href"), \
+                            sqlite3.Binary(pickle.dumps(_unparsed(post), 2))) \
+                            for post in items])
+                elif key == "search":
+                    data = sqlite3.Binary(pickle.dumps(items, 2))
+                else:
+                    data = sqlite3.Binary(pickle.dumps([dict(item) \
+                            for item in items], 2))
+                self.__db.execute("INSERT OR REPLACE INTO content " \
+                        "VALUES (?, ?, ?, ?)", (username, key, lastupdate, data))
+            except:
+                self.__db.execute("ROLLBACK")
+                raise
+            self.__db.execute("COMMIT")
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        self.__db.close()
+
+
 class DeliciousAccount(UserDict):
     """A del.icio.us account"""
 
@@ -117,35 +1951,83 @@ class DeliciousAccount(UserDict):
     __allposts = 0
     __postschanged = 0
 
-    # Time of last request so that the one second limit can be enforced.
-    __lastrequest = None
+    # Running totals of requests made and bytes received.
+    __requests = 0
+    __received = 0
+
+    # Optional persistent cache shared with other processes.
+    __cache = None
+
+    # The time of the last update to the account that the posts held
+    # correspond to and when the time of the last update was last checked.
+    __postsupdate = None
+    __checked = 0
 
     # Special methods
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, cache=None, limiter=None, \
+            staleness=None, compact=0, outbox=None):
         UserDict.__init__(self)
+        self.__username = username
+
+        # Whether posts are returned as compact Post objects rather than
+        # dictionaries.
+        self.compact = compact
 
-        # Authenticate the URL opener so that it can access del.icio.us
+        # The limiter may be shared with other accounts.
+        self.limiter = limiter or RateLimiter()
+
+        # The number of seconds for which the time of the last update is
+        # trusted before it is checked again; None trusts it forever.
+        self.staleness = staleness
+
+        # Each account has its own connections so that several accounts can
+        # be used at once.
         if _debug:
             sys.stderr.write("Initialising DeliciousAccount object.\n")
-        auth_handler = urllib2.HTTPBasicAuthHandler()
-        auth_handler.add_password("del.icio.us API", "https://api.del.icio.us/", \
-                username, password)
-        opener = urllib2.build_opener(auth_handler)
-        opener.addheaders = [("User-agent", USER_AGENT)]
-        urllib2.install_opener(opener)
-        if _debug:
-            sys.stderr.write("URL opener with HTTP authenticiation installed globally.\n")
-        self["lastupdate"] = self.lastupdate()
-        self["lastupdate_parsed"] = time.strptime(self["lastupdate"], \
-                "%Y-%m-%dT%H:%M:%SZ")
-        if _debug:
-            sys.stderr.write("Time of last update loaded into class dictionary.\n")
+        self.connections = ConnectionPool(username, password)
+
+        # Content stored in the persistent cache is loaded when it is first
+        # needed as it is only valid for the current update of the account.
+        if cache and StringTypes and isinstance(cache, StringTypes):
+            cache = DeliciousCache(cache)
+        self.__cache = cache
+        self.__loaded = {}
+
+        # Responses to reads carrying an ETag or Last-Modified header, by URL,
+        # so that they can be reused when del.icio.us reports them unmodified.
+        self.__responses = {}
+        self.__used = 0
+
+        # Callables passed an event dictionary describing each request.
+        self.hooks = []
+
+        # Identical reads made at the same time share one request; the
+        # cache may be replaced with one that also keeps results.
+        self.reads = ReadCache()
+
+        # Changes may be recorded in a durable outbox and made in the
+        # background, starting with any left over from an earlier process.
+        self.__ownsoutbox = outbox and StringTypes and \
+                isinstance(outbox, StringTypes)
+        if self.__ownsoutbox:
+            outbox = Outbox(outbox)
+        self.outbox = outbox
+        self.__drainer = None
+        if outbox:
+            self.__drainer = _OutboxDrainer(self, username)
+            self.__drainer.start()
 
     def __getitem__(self, key):
+        if key in ("lastupdate", "lastupdate_parsed") and \
+                (not self.has_key("lastupdate") or (self.staleness is not None \
+                and time.time() - self.__checked > self.staleness)):
+            self.lastupdate()
         try:
             return UserDict.__getitem__(self, key)
         except KeyError:
+            if key in ("posts", "tags", "bundles", "dates") and self.__load(key):
+                return UserDict.__getitem__(self, key)
             if key == "tags":
                 return self.tags()
             elif key == "dates":
@@ -160,42 +2042,285 @@ class DeliciousAccount(UserDict):
             if _debug:
                 sys.stderr.write("The value of posts has been changed.\n")
             self.__postschanged = 1
+        if key in ("posts", "tags", "bundles", "dates") and \
+                isinstance(value, ListType) and \
+                not isinstance(value, IndexedList):
+            value = _indexedlist(key, value)
         return UserDict.__setitem__(self, key, value)
 
 
-    def __request(self, url):
+    def __open(self, url, event=None, revalidate=1):
 
-        # Make sure that it has been at least 1 second since the last
-        # request was made. If not, halt execution for approximately one
-        # seconds.
-        if self.__lastrequest and (time.time() - self.__lastrequest) < 2:
-            if _debug:
-                sys.stderr.write("It has been less than two seconds since the last request; halting execution for one second.\n")
-            time.sleep(1)
-        if _debug and self.__lastrequest:
-            sys.stderr.write("The delay between requests was %d.\n" % (time.time() - self.__lastrequest))
-        self.__lastrequest = time.time()
-        if _debug:
-            sys.stderr.write("Opening %s.\n" % url)
-        xml = urllib2.urlopen(url)
+        # Ask for a compressed response and, if a response to the same URL
+        # has been stored, only for a new one if it has since changed.
+        # Changes are never stored or revalidated.
+        headers = {"Accept-Encoding": "gzip"}
+        stored = None
+        if revalidate:
+            stored = self.__responses.get(url)
+        if stored:
+            (etag, modified, encoding, body, used) = stored
+            self.__used += 1
+            self.__responses[url] = stored[:-1] + (self.__used,)
+            if etag:
+                headers["If-None-Match"] = etag
+            if modified:
+                headers["If-Modified-Since"] = modified
+        attempt = 0
+        while 1:
+            waited = self.limiter.acquire()
+            if event is not None:
+                event["waited"] += waited
+            self.__requests += 1
+            try:
+                response = self.connections.open(url, headers, event)
+                responseheaders = response.headers
+                break
+            except urllib2.HTTPError, e:
+                if event is not None:
+                    event["status"] = e.code
+                if e.code == 304 and stored:
+                    (response, responseheaders) = (None, e.hdrs)
+                    break
+                if e.code != 503:
+                    raise
+                if attempt >= self.limiter.retries:
+                    raise ThrottleError(url, \
+                            "503 HTTP status code returned by del.icio.us")
+                self.limiter.throttled(attempt, e.headers.get("retry-after"))
+                attempt += 1
+                if event is not None:
+                    event["retries"] = attempt
         self["headers"] = {}
-        for header in xml.headers.headers:
-            (name, value) = header.split(": ")
+        for header in responseheaders.headers:
+            (name, value) = header.split(": ", 1)
             self["headers"][name.lower()] = value[:-2]
-        if xml.headers.status == "503":
-            raise ThrottleError(url, \
-                    "503 HTTP status code returned by del.icio.us")
+        if response is None:
+            if event is not None:
+                event["cached"] = 1
+            xml = StringIO.StringIO(body)
+        else:
+            if event is not None:
+                event["status"] = response.status
+                response = _TimingReader(response, event)
+            xml = _CountingReader(response, self.__receive)
+            encoding = responseheaders.get("content-encoding", "").lower()
+            etag = responseheaders.get("etag")
+            modified = responseheaders.get("last-modified")
+
+            # The body is stored as it was received (so still compressed)
+            # once it has all been read, unless it is too long to keep.
+            if revalidate and (etag or modified):
+                def store(body, url=url, validators=(etag, modified, encoding)):
+                    self.__store(url, validators, body)
+                xml = _RecordingReader(xml, store, _storedsize)
+            elif stored:
+                self.__responses.pop(url, None)
+        if encoding == "gzip":
+            xml = _GzipReader(xml)
+        return xml
+
+    def __store(self, url, validators, body):
+        """Store a response body, discarding the least recently used"""
+        if body is None:
+            self.__responses.pop(url, None)
+            return
+        self.__used += 1
+        self.__responses[url] = validators + (body, self.__used)
+        while len(self.__responses) > _storedcount:
+            oldest = min([(stored[-1], key) for (key, stored) \
+                    in self.__responses.items()])[1]
+            self.__responses.pop(oldest, None)
+
+    def __load(self, key):
+        """Load content from the persistent cache, returning whether it was"""
+        if not self.__cache or self.__loaded.has_key(key):
+            return 0
+        self.__loaded[key] = 1
+        items = self.__cache.load(self.__username, key, self["lastupdate"])
+        if items is None:
+            return 0
+        if _debug:
+            sys.stderr.write("Loaded %s from the cache.\n" % key)
+        UserDict.__setitem__(self, key, _indexedlist(key, items, self.compact))
+        if key == "posts":
+            self.__allposts = 1
+            self.__postsupdate = self["lastupdate"]
+        return 1
+
+    def __receive(self, count):
+        self.__received += count
+
+    def __request(self, url, tagname=None, revalidate=1):
+        """Request a URL, returning its document or elements named tagname"""
+        if not self.hooks and not _debug:
+            document = minidom.parseString(self.__open(url, None, \
+                    revalidate).read())
+            if tagname:
+                return document.getElementsByTagName(tagname)
+            return document
+        event = self.__event(url)
+        try:
+            xml = self.__open(url, event, revalidate)
+            start = time.time()
+            document = minidom.parseString(xml.read())
+            if tagname:
+                document = document.getElementsByTagName(tagname)
+                event["items"] = len(document)
+        except:
+            event["error"] = sys.exc_info()[0]
+            self.__notify(event)
+            raise
+        event["parse"] = time.time() - start - event["download"]
+        self.__notify(event)
+        return document
+
+    def __event(self, url):
+        """Return a new event describing a request for a URL"""
+        (path, query) = (url[len(DELICIOUS_API) + 1:].split("?", 1) + [""])[:2]
+        return {"account": self.__username, "endpoint": path, "url": url, \
+                "query": len(query), "started": time.time(), "waited": 0.0, \
+                "connect": 0.0, "ttfb": 0.0, "download": 0.0, "parse": 0.0, \
+                "seconds": 0.0, "bytes": 0, "items": 0, "status": None, \
+                "retries": 0, "reconnected": 0, "cached": 0, "error": None}
+
+    def __notify(self, event):
+        """Pass a finished event to every hook"""
+        event["seconds"] = time.time() - event["started"]
         if _debug:
-            sys.stderr.write("%s opened successfully.\n" % url)
-        return minidom.parseString(xml.read())
+            sys.stderr.write("%(endpoint)s: status %(status)s, %(bytes)d " \
+                    "bytes, %(items)d items, %(retries)d retries in " \
+                    "%(seconds).3f seconds (waited %(waited).3f, connect " \
+                    "%(connect).3f, first byte %(ttfb).3f, download " \
+                    "%(download).3f, parse %(parse).3f).\n" % event)
+
+        # A failing hook must not make a request that succeeded look failed.
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception, e:
+                if _debug:
+                    sys.stderr.write("Hook %r failed: %s\n" % (hook, e))
+
+    def __postsquery(self, tag, date, todt, fromdt, count):
+        """Return the API path and query for a request for posts"""
+        query = {}
+
+        ## if a date is passed then a ranged set of date params CANNOT be passed
+        if date and (todt or fromdt):
+            raise DateParamsError
+
+        if not count and not date and not todt and not fromdt and not tag:
+            path = "all"
+        elif date:
+            path = "get"
+        elif todt or fromdt:
+            path = "all"
+        else:
+            path = "recent"
+        if count:
+            query["count"] = count
+        if tag:
+            query["tag"] = tag
+        if todt:
+            query["todt"] = _ymd(todt)
+        if fromdt:
+            query["fromdt"] = _ymd(fromdt)
+        if date:
+            query["dt"] = _ymd(date)
+        return (path, query)
+
+
+    # Methods to fetch del.icio.us content
+
+    def lastupdate(self):
+        """Return the last time that the del.icio.us account was updated."""
+        lastupdate = self.__request("%s/posts/update" % DELICIOUS_API, \
+                "update")[0].getAttribute("time")
+
+        # Reads kept from before an update are out of date.
+        if UserDict.get(self, "lastupdate") not in (None, lastupdate):
+            self.reads.invalidate(self.__username)
+        UserDict.__setitem__(self, "lastupdate", lastupdate)
+        UserDict.__setitem__(self, "lastupdate_parsed", \
+                time.strptime(lastupdate, "%Y-%m-%dT%H:%M:%SZ"))
+        self.__checked = time.time()
+        if _debug:
+            sys.stderr.write("Time of last update loaded into class dictionary.\n")
+        return lastupdate
+
+    def __lastupdate(self, since):
+        """Return the time of the last update, checking it if need be
+
+        It is not checked again if it was checked after `since` or less than
+        `staleness` seconds ago.
+
+        """
+        if self.has_key("lastupdate") and (self.__checked >= since or \
+                (self.staleness is not None and \
+                time.time() - self.__checked <= self.staleness)):
+            return UserDict.__getitem__(self, "lastupdate")
+        return self.lastupdate()
+
+    def iterposts(self, tag="", date="", todt="", fromdt="", count=0):
+        """Iterate over del.icio.us bookmarks as they are downloaded.
+
+        Takes the same arguments as posts() but yields each post dictionary
+        as soon as it has been parsed rather than building a list, so memory
+        use stays flat however many posts there are. Posts yielded here are
+        not stored in the class dictionary.
+
+        """
+        for attrs in self.__iterattrs(tag, date, todt, fromdt, count):
+            if self.compact:
+                yield Post(attrs)
+            else:
+                yield _postdict(attrs)
+
+    def __iterattrs(self, tag, date, todt, fromdt, count):
+        """Iterate over the attributes of each post element downloaded"""
+        (path, query) = self.__postsquery(tag, date, todt, fromdt, count)
+        url = "%s/posts/%s?%s" % (DELICIOUS_API, path, _urlencode(query))
+        if not self.hooks and not _debug:
+            response = self.__open(url)
+            for attrs in _iterparse(response, u"post"):
+                yield attrs
+            response.close()
+            return
+
+        # Time spent by the caller between posts is not counted as parsing.
+        event = self.__event(url)
+        try:
+            try:
+                response = self.__open(url, event)
+                start = time.time()
+                for attrs in _iterparse(response, u"post"):
+                    event["items"] += 1
+                    event["parse"] += time.time() - start
+                    yield attrs
+                    start = time.time()
+                event["parse"] += time.time() - start
+                event["parse"] -= event["download"]
+                response.close()
 
+            # Abandoning the iteration part way through is not an error.
+            except Exception:
+                event["error"] = sys.exc_info()[0]
+                raise
+        finally:
+            self.__notify(event)
 
-    # Methods to fetch del.icio.us content
+    def posts_table(self, tag="", date="", todt="", fromdt="", count=0):
+        """Return del.icio.us bookmarks as a PostTable.
 
-    def lastupdate(self):
-        """Return the last time that the del.icio.us account was updated."""
-        return self.__request("%s/posts/update" % \
-                DELICIOUS_API).firstChild.getAttribute("time")
+        Takes the same arguments as posts() but stores each post straight
+        into columns as it is parsed without making a dictionary for it.
+
+        """
+        table = PostTable()
+        for attrs in self.__iterattrs(tag, date, todt, fromdt, count):
+            table.append(attrs)
+        return table
 
     def posts(self, tag="", date="", todt="", fromdt="", count=0):
         """Return del.icio.us bookmarks as a list of dictionaries.
@@ -206,104 +2331,137 @@ class DeliciousAccount(UserDict):
         servers.
 
         """
-        query = {}
-
-        ## if a date is passed then a ranged set of date params CANNOT be passed
-        if date and (todt or fromdt):
-            raise DateParamsError
-
         if not count and not date and not todt and not fromdt and not tag:
-            path = "all"
 
             # If attempting to load all of the posts from del.icio.us, and
             # a previous download has been done, check to see if there has
             # been an update; if not, then just return the posts stored
             # inside the class.
-            if _debug:
-                sys.stderr.write("Checking to see if a previous download has been made.\n")
-            if not self.__postschanged and self.__allposts and \
-                    self.lastupdate() == self["lastupdate"]:
-                if _debug:
-                    sys.stderr.write("It has; returning old posts instead.\n")
-                return self["posts"]
+            start = time.time()
+            self.__load("posts")
+            if not self.__postschanged and self.__allposts:
+                if self.__lastupdate(start) == self.__postsupdate:
+                    return self["posts"]
             elif not self.__allposts:
-                if _debug:
-                    sys.stderr.write("Making note of request for all posts.\n")
                 self.__allposts = 1
-        elif date:
-            path = "get"
-        elif todt or fromdt:
-            path = "all"
-        else:
-            path = "recent"
-        if count:
-            query["count"] = count
-        if tag:
-            query["tag"] = tag
-
-        ##todt
-        if todt and (isinstance(todt, ListType) or isinstance(todt, TupleType)):
-            query["todt"] = "-".join([str(x) for x in todt[:3]])
-        elif todt and (todt and isinstance(todt, datetime.datetime) or \
-                isinstance(todt, datetime.date)):
-            query["todt"] = "-".join([str(todt.year), str(todt.month), str(todt.day)])
-        elif todt:
-            query["todt"] = todt
-
-        ## fromdt
-        if fromdt and (isinstance(fromdt, ListType) or isinstance(fromdt, TupleType)):
-            query["fromdt"] = "-".join([str(x) for x in fromdt[:3]])
-        elif fromdt and (fromdt and isinstance(fromdt, datetime.datetime) or \
-                isinstance(fromdt, datetime.date)):
-            query["fromdt"] = "-".join([str(fromdt.year), str(fromdt.month), str(fromdt.day)])
-        elif fromdt:
-            query["fromdt"] = fromdt
-
-        if date and (isinstance(date, ListType) or isinstance(date, TupleType)):
-            query["dt"] = "-".join([str(x) for x in date[:3]])
-        elif date and (datetime and isinstance(date, datetime.datetime) or \
-                isinstance(date, datetime.date)):
-            query["dt"] = "-".join([str(date.year), str(date.month), str(date.day)])
-        elif date:
-            query["dt"] = date
+            self.__postsupdate = self["lastupdate"]
+        posts = _indexedlist("posts")
 
-        postsxml = self.__request("%s/posts/%s?%s" % (DELICIOUS_API, path, \
-                urllib.urlencode(query))).getElementsByTagName("post")
-        posts = []
-        if _debug:
-            sys.stderr.write("Parsing posts XML into a list of dictionaries.\n")
-
-        # For each post, extract every attribute (splitting tags into sub-lists)
-        # and insert as a dictionary into the `posts` list.
-        for post in postsxml:
-            postdict = {}
-            for (name, value) in post.attributes.items():
-                if name == u"tag":
-                    name = u"tags"
-                    value = value.split(" ")
-                if name == u"time":
-                    postdict[u"time_parsed"] = time.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
-                postdict[name] = value
-            if self.has_key("posts") and isinstance(self["posts"], ListType) \
-                    and postdict not in self["posts"]:
+        # Insert each post as it is parsed into the `posts` list.
+        for postdict in self.iterposts(tag, date, todt, fromdt, count):
+            if self.has_key("posts") and isinstance(self["posts"], IndexedList):
                 self["posts"].append(postdict)
             posts.append(postdict)
-        if _debug:
-            sys.stderr.write("Inserting posts list into class attribute.\n")
         if not self.has_key("posts"):
             self["posts"] = posts
-        if _debug:
-            sys.stderr.write("Resetting marker so module doesn't think posts has been changed.\n")
         self.__postschanged = 0
+        if self.__cache and not count and not date and not todt and \
+                not fromdt and not tag:
+            self.__cache.save(self.__username, "posts", posts, \
+                    self.__postsupdate)
         return posts
 
+    def sync(self):
+        """Bring the posts attribute up to date with del.icio.us.
+
+        Rather than downloading every post again when the account has been
+        updated, the number of posts made on each date is compared with the
+        posts held locally and only the dates that differ are requested.
+        Note that a post edited without changing the number of posts on its
+        date cannot be noticed this way.
+
+        Returns a dictionary with the number of requests made, bytes
+        received, dates requested and posts added, updated and deleted.
+
+        """
+        requests = self.__requests
+        received = self.__received
+        report = {"dates": 0, "added": 0, "updated": 0, "deleted": 0}
+        start = time.time()
+        self.__load("posts")
+        if self.__postschanged or not self.__allposts or \
+                not isinstance(UserDict.get(self, "posts"), PostList):
+            if _debug:
+                sys.stderr.write("No complete set of posts; downloading all posts.\n")
+            before = len(UserDict.get(self, "posts") or ())
+            self.posts()
+            report["added"] = len(self["posts"]) - before
+        else:
+            lastupdate = self.__lastupdate(start)
+            if lastupdate != self.__postsupdate:
+                report.update(self.__syncdates())
+                self.__postsupdate = lastupdate
+                self.__postschanged = 0
+                if self.__cache:
+                    self.__cache.save(self.__username, "posts", \
+                            self["posts"], lastupdate)
+                    self.__cache.save(self.__username, "dates", \
+                            self["dates"], lastupdate)
+                    self.__savesearch()
+        report["requests"] = self.__requests - requests
+        report["bytes"] = self.__received - received
+        return report
+
+    def __syncdates(self):
+        """Fetch the posts for every date whose count has changed"""
+        report = {"dates": 0, "added": 0, "updated": 0, "deleted": 0}
+        posts = self["posts"]
+        local = posts.days()
+        remote = {}
+        dates = self.__dates()
+        for datedict in dates:
+            remote[datedict[u"date"]] = datedict[u"count"]
+        self["dates"] = dates
+        days = local.copy()
+        days.update(remote)
+        fetched = []
+        stale = []
+        for day in days.keys():
+            if local.get(day, 0) == remote.get(day, 0):
+                continue
+            if _debug:
+                sys.stderr.write("Posts on %s have changed.\n" % day)
+            report["dates"] += 1
+            current = {}
+            if remote.get(day, 0):
+                for postdict in self.iterposts(date=day):
+                    current[postdict[u"href"]] = 1
+                    fetched.append(postdict)
+            for postdict in posts.dated(day):
+                if not current.has_key(postdict[u"href"]):
+                    stale.append(postdict[u"href"])
+
+        # Posts that have only moved to another date are updated rather than
+        # deleted.
+        current = {}
+        for postdict in fetched:
+            current[postdict[u"href"]] = 1
+        for href in stale:
+            if not current.has_key(href) and href in posts:
+                posts.remove(href)
+                report["deleted"] += 1
+        for postdict in fetched:
+            if postdict[u"href"] not in posts:
+                report["added"] += 1
+            elif postdict not in posts:
+                report["updated"] += 1
+            posts.append(postdict)
+        return report
+
+    def __read(self, key, function, *args):
+        """Make a read through the read cache, holding its result if new"""
+        value = self.reads.fetch((self.__username, key) + args, function, *args)
+        if not self.has_key(key):
+            self[key] = value
+        return value
+
     def tags(self):
         """Return a dictionary of tags with the number of posts in each one"""
-        tagsxml = self.__request("%s/tags/get?" % \
-                DELICIOUS_API).getElementsByTagName("tag")
-        tags = []
-        if _debug:
-            sys.stderr.write("Parsing tags XML into a list of dictionaries.\n")
+        return self.__read("tags", self.__tags)
+
+    def __tags(self):
+        tagsxml = self.__request("%s/tags/get?" % DELICIOUS_API, "tag")
+        tags = _indexedlist("tags")
         for tag in tagsxml:
             tagdict = {}
             for (name, value) in tag.attributes.items():
@@ -312,48 +2470,48 @@ class DeliciousAccount(UserDict):
                 elif name == u"count":
                     value = int(value)
                 tagdict[name] = value
-            if self.has_key("tags") and isinstance(self["tags"], ListType) \
-                    and tagdict not in self["tags"]:
+            if self.has_key("tags") and isinstance(self["tags"], IndexedList):
                 self["tags"].append(tagdict)
             tags.append(tagdict)
-        if _debug:
-            sys.stderr.write("Inserting tags list into class attribute.\n")
         if not self.has_key("tags"):
             self["tags"] = tags
+        if self.__cache:
+            self.__cache.save(self.__username, "tags", tags, self["lastupdate"])
         return tags
 
     def bundles(self):
         """Return a dictionary of all bundles"""
-        bundlesxml = self.__request("%s/tags/bundles/all" % \
-                DELICIOUS_API).getElementsByTagName("bundle")
-        bundles = []
-        if _debug:
-            sys.stderr.write("Parsing bundles XML into a list of dictionaries.\n")
+        return self.__read("bundles", self.__bundles)
+
+    def __bundles(self):
+        bundlesxml = self.__request("%s/tags/bundles/all" % DELICIOUS_API, \
+                "bundle")
+        bundles = _indexedlist("bundles")
         for bundle in bundlesxml:
             bundledict = {}
             for (name, value) in bundle.attributes.items():
                 bundledict[name] = value
-            if self.has_key("bundles") and isinstance(self["bundles"], ListType) \
-                    and bundledict not in self["bundles"]:
+            if self.has_key("bundles") and isinstance(self["bundles"], IndexedList):
                 self["bundles"].append(bundledict)
             bundles.append(bundledict)
-        if _debug:
-            sys.stderr.write("Inserting bundles list into class attribute.\n")
         if not self.has_key("bundles"):
             self["bundles"] = bundles
+        if self.__cache:
+            self.__cache.save(self.__username, "bundles", bundles, self["lastupdate"])
         return bundles
 
     def dates(self, tag=""):
         """Return a dictionary of dates with the number of posts at each date"""
+        return self.__read("dates", self.__dates, tag)
+
+    def __dates(self, tag=""):
         if tag:
-            query = urllib.urlencode({"tag":tag})
+            query = _urlencode({"tag":tag})
         else:
             query = ""
-        datesxml = self.__request("%s/posts/dates?%s" % \
-                (DELICIOUS_API, query)).getElementsByTagName("date")
-        dates = []
-        if _debug:
-            sys.stderr.write("Parsing dates XML into a list of dictionaries.\n")
+        datesxml = self.__request("%s/posts/dates?%s" % (DELICIOUS_API, \
+                query), "date")
+        dates = _indexedlist("dates")
         for date in datesxml:
             datedict = {}
             for (name, value) in date.attributes.items():
@@ -362,64 +2520,333 @@ class DeliciousAccount(UserDict):
                 elif name == u"count":
                     value = int(value)
                 datedict[name] = value
-            if self.has_key("dates") and isinstance(self["dates"], ListType) \
-                    and datedict not in self["dates"]:
+            if self.has_key("dates") and isinstance(self["dates"], IndexedList) \
+                    and (not tag or datedict[u"date"] not in self["dates"]):
                 self["dates"].append(datedict)
             dates.append(datedict)
-        if _debug:
-            sys.stderr.write("Inserting dates list into class attribute.\n")
         if not self.has_key("dates"):
             self["dates"] = dates
+        if self.__cache and not tag:
+            self.__cache.save(self.__username, "dates", dates, self["lastupdate"])
         return dates
 
 
     # Methods to modify del.icio.us content
 
+    def _change(self, path, query, error):
+        """Make a change to del.icio.us, raising `error` if it is refused"""
+        response = self.__request("%s/%s?%s" % (DELICIOUS_API, path, \
+                _urlencode(query)), "result", 0)
+        code = response[0].getAttribute("code")
+        if code != u"done":
+            raise error(code)
+        self.reads.invalidate(self.__username)
+        self.__changed(path, query)
+
+    def __changed(self, path, query):
+        """Make a change that del.icio.us has accepted to the content held"""
+        if path.startswith("tags/"):
+            return self.__tagschanged(path, query)
+        posts = UserDict.get(self, "posts")
+        if not isinstance(posts, PostList):
+            return
+        if path == "posts/add":
+            attrs = {u"href": query["url"], \
+                    u"description": query["description"], \
+                    u"extended": query.get("extended", ""), \
+                    u"tag": query.get("tags", ""), \
+                    u"time": query.get("dt") or \
+                    time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+            if self.compact:
+                posts.append(Post(attrs))
+            else:
+                posts.append(_postdict(attrs))
+        elif path == "posts/delete" and query["url"] in posts:
+            posts.remove(query["url"])
+        else:
+            return
+
+        # The posts held no longer match any known update to the account.
+        self.__postsupdate = None
+
+    def __tagschanged(self, path, query):
+        """Rename a tag or change a bundle in the posts, tags and bundles held"""
+        bundles = UserDict.get(self, "bundles")
+        if path == "tags/bundles/set" and isinstance(bundles, IndexedList):
+            bundles.append({u"name": query["bundle"], \
+                    u"tags": query.get("tags", "")})
+        elif path == "tags/bundles/delete" and isinstance(bundles, IndexedList):
+            if query["bundle"] in bundles:
+                bundles.remove(query["bundle"])
+        if path != "tags/rename":
+            return
+        (old, new) = (query["old"], query["new"])
+        posts = UserDict.get(self, "posts")
+        if isinstance(posts, PostList):
+            for post in posts.tagged(old):
+                if isinstance(post, Post):
+                    renamed = _unparsed(post)
+                else:
+                    renamed = dict(post.items())
+                tags = []
+                for tag in post.get(u"tags", ()):
+                    if tag == old:
+                        tag = new
+                    if tag not in tags:
+                        tags.append(tag)
+                renamed[u"tags"] = tags
+                posts.append(renamed)
+            self.__postsupdate = None
+        tags = UserDict.get(self, "tags")
+        if isinstance(tags, IndexedList) and old in tags:
+            count = tags.get(old)[u"count"]
+            tags.remove(old)
+            if isinstance(posts, PostList):
+                count = len(posts.tagged(new))
+            elif new in tags:
+                count += tags.get(new)[u"count"]
+            tags.append({u"name": new, u"count": count})
+
+    def search(self, query, limit=None):
+        """Return the posts matching a search query, best first.
+
+        Posts are searched locally, using an index of their words built
+        when first searched and kept up to date as posts change, and are
+        only downloaded if none are held. See SearchIndex for the query
+        syntax. If the account has a cache, the index is stored in it.
+
+        """
+        posts = self["posts"]
+        if posts._search is None and self.__cache and self.__postsupdate:
+            posts._search = self.__cache.load(self.__username, "search", \
+                    self.__postsupdate)
+            if posts._search is not None and posts._search.count != len(posts):
+                posts._search = None
+        if posts._search is None:
+            posts._search = SearchIndex(posts)
+            self.__savesearch()
+        return posts.search(query, limit)
+
+    def related_tags(self, tag, n=10):
+        """Return up to n tags most often used on the same posts as a tag.
+
+        Each is a dictionary of the tag's name and the number of posts
+        (count) that it shares with the tag. The counts are kept for the
+        posts held by the account, which are only downloaded if none are
+        held, and are updated as posts change.
+
+        """
+        return self["posts"].related_tags(tag, n)
+
+    def suggest_tags(self, url_or_tags, n=10):
+        """Return up to n tags to suggest for a URL or a list of tags.
+
+        Tags are suggested by how often they are used with the given tags
+        (or those already on the URL) on the posts held, how often they are
+        used on the URL's site and whether they appear in the URL. Each is a
+        dictionary of the tag's name and its score. A string of tags
+        separated by spaces may be given instead of a list.
+
+        """
+        return self["posts"].suggest_tags(url_or_tags, n)
+
+    def export(self, fileobj, format="jsonl"):
+        """Write every post to a file as it is downloaded.
+
+        The format is either "jsonl", with a JSON object per line (which
+        needs Python 2.6 or simplejson), or "netscape" for the HTML
+        bookmark files read by web browsers. Posts are written as soon as
+        they are parsed so memory use stays flat however many there are.
+        Returns the number of posts written.
+
+        """
+        if format == "jsonl" and json is None:
+            raise DeliciousError("The json module is required for JSON export")
+        elif format not in ("jsonl", "netscape"):
+            raise DeliciousError("Unknown export format: %s" % format)
+        count = 0
+        if format == "netscape":
+            fileobj.write(_netscapeheader)
+        for post in self.iterposts():
+            if format == "netscape":
+                fileobj.write(_netscape(post))
+            else:
+                fileobj.write(json.dumps(_record(post)) + "\n")
+            count += 1
+        if format == "netscape":
+            fileobj.write("</DL><p>\n")
+        return count
+
+    def import_(self, fileobj, format="jsonl", checkpoint=None, \
+            batchsize=100, retries=3):
+        """Add every post in a file written by export() (or a browser).
+
+        Posts are read as they are needed and added in batches of
+        `batchsize` (see batch()), skipping those already held unchanged.
+        If `checkpoint` is the path of a file, the number of posts added
+        is recorded in it after each batch and an import given the same
+        checkpoint starts after the posts that it records. The import stops
+        at the first post that cannot be added. Returns a dictionary of the
+        number of posts `read`, `added` and `skipped` (including those
+        before the checkpoint) and the result of any `failure`.
+
+        """
+        if format == "jsonl" and json is None:
+            raise DeliciousError("The json module is required for JSON import")
+        elif format == "jsonl":
+            records = _jsonrecords(fileobj)
+        elif format == "netscape":
+            records = _netscaperecords(fileobj)
+        else:
+            raise DeliciousError("Unknown import format: %s" % format)
+        done = 0
+        if checkpoint and os.path.exists(checkpoint):
+            done = int(file(checkpoint).read().strip() or 0)
+        report = {"read": 0, "added": 0, "skipped": done, "failure": None}
+        batch = self.batch(retries)
+        for record in records:
+            report["read"] += 1
+            if report["read"] <= done:
+                continue
+            tags = record.get(u"tags", ())
+            batch.add(record.get(u"href") or record.get(u"url"), \
+                    record.get(u"description", u""), \
+                    record.get(u"extended", u""), tags, \
+                    record.get(u"time") or record.get(u"dt", u""))
+            if len(batch.changes) >= batchsize and \
+                    not self.__importbatch(batch, report, checkpoint):
+                return report
+        if batch.changes:
+            self.__importbatch(batch, report, checkpoint)
+        return report
+
+    def __importbatch(self, batch, report, checkpoint):
+        """Run a batch of an import, returning whether it all succeeded"""
+        for result in batch.run(stop=1):
+            if not result["ok"]:
+                report["failure"] = result
+                break
+            if result["skipped"]:
+                report["skipped"] += 1
+            else:
+                report["added"] += 1
+        batch.changes = []
+        if checkpoint:
+            _checkpoint(checkpoint, report["added"] + report["skipped"])
+        return report["failure"] is None
+
+    def __savesearch(self):
+        """Store the search index of the posts held in the cache, if any"""
+        posts = UserDict.get(self, "posts")
+        if self.__cache and self.__postsupdate and \
+                isinstance(posts, PostList) and posts._search is not None:
+            self.__cache.save(self.__username, "search", posts._search, \
+                    self.__postsupdate)
+
+    def __enqueue(self, operation, key, path, query):
+        """Record a change in the outbox for the drainer to make"""
+        if not self.__drainer:
+            raise DeliciousError("The account has been closed")
+        self.outbox.put(self.__username, operation, key, path, query)
+        self.__drainer.wake.set()
+
+    def flush(self, timeout=None):
+        """Wait for the changes in the outbox to be made.
+
+        Returns whether every change was made (or failed) within `timeout`
+        seconds. Changes that failed can be found with outbox.failures().
+
+        """
+        if not self.outbox:
+            return 1
+        if not self.__drainer:
+            raise DeliciousError("The account has been closed")
+        if timeout is not None:
+            timeout = time.time() + timeout
+        while self.outbox.count(self.__username):
+            if not self.__drainer.isAlive():
+                raise DeliciousError("The outbox is no longer being drained")
+            if timeout is not None and time.time() > timeout:
+                return 0
+            self.__drainer.wake.set()
+            time.sleep(0.05)
+        return 1
+
+    def close(self):
+        """Stop making changes from the outbox and close idle connections
+
+        Changes not yet made are left in the outbox for the next account
+        opened with it. An outbox opened by the account from a file name is
+        closed too.
+
+        """
+        if self.__drainer:
+            self.__drainer.stop()
+            if self.__drainer is not threading.currentThread():
+                self.__drainer.join()
+            self.__drainer = None
+        if self.outbox and self.__ownsoutbox:
+            self.outbox.close()
+        self.connections.close()
+
+    def batch(self, retries=3):
+        """Return a new batch of changes to make to this account"""
+        return Batch(self, retries)
+
+    def reconcile_tags(self, renames=None, merges=None, bundles=None, \
+            prune=0, dryrun=0, retries=3):
+        """Rename tags and change bundles to reach a desired state.
+
+        `renames` maps tags to their new names and `merges` maps tags to
+        lists of tags to merge into them; all of the renames happen at
+        once so chains and swaps work as expected. `bundles` maps bundles
+        to their tags or to None to delete them; other bundles have their
+        tags renamed and, if `prune` is true, are deleted. The current tags
+        and bundles are compared with the desired state to make as few
+        changes as possible, which are returned as a list of tuples of a
+        Batch method name and its arguments if `dryrun` is true. Otherwise
+        they are made in order (stopping at the first failure) with the
+        tags, bundles and posts held updated to match, and the results of
+        Batch.run() are returned.
+
+        The current tags and bundles are read again (see tags() and
+        bundles()). Renaming a tag that does not exist raises
+        RenameTagError unless its new name does, i.e. unless it has already
+        been renamed; tags to merge that do not exist are ignored.
+
+        """
+        tags = [tagdict[u"name"] for tagdict in self.tags()]
+        current = {}
+        for bundledict in self.bundles():
+            current[bundledict[u"name"]] = bundledict.get(u"tags", u"")
+        existing = {}
+        for tag in tags:
+            existing[tag] = 1
+        unknown = [old for (old, new) in (renames or {}).items() \
+                if not existing.has_key(old) and not existing.has_key(new)]
+        if unknown:
+            unknown.sort()
+            raise RenameTagError("No such tags: %s" % " ".join(unknown))
+        renames = dict(renames or {})
+        for (tag, merged) in (merges or {}).items():
+            for old in merged:
+                renames[old] = tag
+        changes = _plantags(tags, current, renames, bundles or {}, prune)
+        if dryrun:
+            return changes
+        batch = self.batch(retries)
+        for (operation, args) in changes:
+            getattr(batch, operation)(*args)
+        return batch.run(stop=1)
+
     def add(self, url, description, extended="", tags=(), date=""):
         """Add a new post to del.icio.us"""
-        query = {}
-        query["url"] = url
-        query ["description"] = description
-        if extended:
-            query["extended"] = extended
-        if tags and (isinstance(tags, TupleType) or isinstance(tags, ListType)):
-            query["tags"] = " ".join(tags)
-        elif tags and (StringTypes and isinstance(tags, StringTypes)) or \
-                (not StringTypes and (isinstance(tags, StringType) or \
-                isinstance(tags, UnicodeType))):
-            query["tags"] = tags
-
-        # This is a rather rudimentary way of parsing date strings into
-        # ISO8601 dates: if the date string is shorter than the required
-        # 20 characters then it is assumed that it is a partial date
-        # such as "2005-3-31" or "2005-3-31T20:00" and it is split into a
-        # list along non-numerals. Empty elements are then removed
-        # and then this is passed to the tuple/list case where
-        # the tuple/list is padded with necessary 0s and then formatted
-        # into an ISO8601 date string. This does not take into account
-        # time zones.
-        if date and (StringTypes and isinstance(tags, StringTypes)) or \
-                (not StringTypes and (isinstance(tags, StringType) or \
-                isinstance(tags, UnicodeType))) and len(date) < 20:
-            date = re.split("\D", date)
-            while '' in date:
-                date.remove('')
-        if date and (isinstance(date, ListType) or isinstance(date, TupleType)):
-            date = list(date)
-            if len(date) > 2 and len(date) < 6:
-                for i in range(6 - len(date)):
-                    date.append(0)
-            query["dt"] = "%.4d-%.2d-%.2dT%.2d:%.2d:%.2dZ" % tuple(date)
-        elif date and (datetime and (isinstance(date, datetime.datetime) \
-                or isinstance(date, datetime.date))):
-            query["dt"] = "%.4d-%.2d-%.2dT%.2d:%.2d:%.2dZ" % date.utctimetuple()[:6]
-        elif date:
-            query["dt"] = date
+        if self.outbox:
+            return self.__enqueue("add", url, "posts/add", \
+                    _addquery(url, description, extended, tags, date))
         try:
-            response = self.__request("%s/posts/add?%s" % (DELICIOUS_API, \
-                    urllib.urlencode(query)))
-            if response.firstChild.getAttribute("code") != u"done":
-                raise AddError
+            self._change("posts/add", _addquery(url, description, extended, \
+                    tags, date), AddError)
             if _debug:
                 sys.stderr.write("Post, %s (%s), added to del.icio.us\n" \
                         % (description, url))
@@ -430,17 +2857,11 @@ class DeliciousAccount(UserDict):
 
     def bundle(self, bundle, tags):
         """Bundle a set of tags together"""
-        query = {}
-        query["bundle"] = bundle
-        if tags and (isinstance(tags, TupleType) or isinstance(tags, ListType)):
-            query["tags"] = " ".join(tags)
-        elif tags and isinstance(tags, StringTypes):
-            query["tags"] = tags
-        try:
-            response = self.__request("%s/tags/bundles/set?%s" % (DELICIOUS_API, \
-                    urllib.urlencode(query)))
-            if response.firstChild.getAttribute("code") != u"done":
-                raise BundleError
+        if self.outbox:
+            return self.__enqueue("bundle", bundle, "tags/bundles/set", _bundlequery(bundle, tags))
+        try:
+            self._change("tags/bundles/set", _bundlequery(bundle, tags), \
+                    BundleError)
             if _debug:
                 sys.stderr.write("Tags, %s, bundled into %s.\n" \
                         % (repr(tags), bundle))
@@ -451,11 +2872,10 @@ class DeliciousAccount(UserDict):
 
     def delete(self, url):
         """Delete post from del.icio.us by its URL"""
+        if self.outbox:
+            return self.__enqueue("delete", url, "posts/delete", {"url":url})
         try:
-            response = self.__request("%s/posts/delete?%s" % (DELICIOUS_API, \
-                    urllib.urlencode({"url":url})))
-            if response.firstChild.getAttribute("code") != u"done":
-                raise DeleteError
+            self._change("posts/delete", {"url":url}, DeleteError)
             if _debug:
                 sys.stderr.write("Post, %s, deleted from del.icio.us\n" \
                         % url)
@@ -466,11 +2886,11 @@ class DeliciousAccount(UserDict):
 
     def delete_bundle(self, name):
         """Delete bundle from del.icio.us by its name"""
+        if self.outbox:
+            return self.__enqueue("delete_bundle", name, "tags/bundles/delete", {"bundle":name})
         try:
-            response = self.__request("%s/tags/bundles/delete?%s" % (DELICIOUS_API, \
-                    urllib.urlencode({"bundle":name})))
-            if response.firstChild.getAttribute("code") != u"done":
-                raise DeleteBundleError
+            self._change("tags/bundles/delete", {"bundle":name}, \
+                    DeleteBundleError)
             if _debug:
                 sys.stderr.write("Bundle, %s, deleted from del.icio.us\n" \
                         % name)
@@ -481,12 +2901,10 @@ class DeliciousAccount(UserDict):
 
     def rename_tag(self, old, new):
         """Rename a tag"""
-        query = {"old":old, "new":new}
+        if self.outbox:
+            return self.__enqueue("rename_tag", old, "tags/rename", {"old":old, "new":new})
         try:
-            response = self.__request("%s/tags/rename?%s" % (DELICIOUS_API, \
-                    urllib.urlencode(query)))
-            if response.firstChild.getAttribute("code") != u"done":
-                raise RenameTagError
+            self._change("tags/rename", {"old":old, "new":new}, RenameTagError)
             if _debug:
                 sys.stderr.write("Tag, %s, renamed to %s\n" \
                         % (old, new))
@@ -495,6 +2913,717 @@ class DeliciousAccount(UserDict):
                 sys.stderr.write("Unable to rename %s tag to %s in del.icio.us\n" \
                     % (old, new))
 
+
+# Batches of changes
+
+class Batch:
+    """A list of changes to make to a del.icio.us account in one go
+
+    Changes are queued with add(), delete(), bundle(), delete_bundle() and
+    rename_tag(), which take the same arguments as the methods of the
+    account and return the batch so that calls may be chained, and then
+    made as quickly as the account's rate limiter allows by run().
+
+    """
+
+    def __init__(self, account, retries=3):
+        self.account = account
+        self.retries = retries
+        self.changes = []
+
+    def __queue(self, operation, key, path, query, error):
+        self.changes.append((operation, key, path, query, error))
+        return self
+
+    def add(self, url, description, extended="", tags=(), date=""):
+        return self.__queue("add", url, "posts/add", \
+                _addquery(url, description, extended, tags, date), AddError)
+
+    def delete(self, url):
+        return self.__queue("delete", url, "posts/delete", {"url":url}, \
+                DeleteError)
+
+    def bundle(self, bundle, tags):
+        return self.__queue("bundle", bundle, "tags/bundles/set", \
+                _bundlequery(bundle, tags), BundleError)
+
+    def delete_bundle(self, name):
+        return self.__queue("delete_bundle", name, "tags/bundles/delete", \
+                {"bundle":name}, DeleteBundleError)
+
+    def rename_tag(self, old, new):
+        return self.__queue("rename_tag", old, "tags/rename", \
+                {"old":old, "new":new}, RenameTagError)
+
+    def __unchanged(self, query):
+        """Whether the account already holds a post identical to an add"""
+        if not self.account.has_key("posts") or \
+                not isinstance(self.account["posts"], PostList):
+            return 0
+        post = self.account["posts"].get(query["url"])
+        if post is None:
+            return 0
+        tags = [tag for tag in post.get(u"tags", ()) if tag]
+        newtags = [tag for tag in query.get("tags", "").split(" ") if tag]
+        tags.sort()
+        newtags.sort()
+        return post.get(u"description") == query["description"] and \
+                post.get(u"extended", u"") == query.get("extended", "") and \
+                tags == newtags and \
+                (not query.get("dt") or post.get(u"time") == query["dt"])
+
+    def run(self, stop=0):
+        """Make every queued change and return a list of results
+
+        Each result is a dictionary of the `operation` and its `key` (the URL,
+        bundle or tag changed), whether it was `ok` or `skipped` because
+        the account already holds an identical post, the `error` class and
+        `message` of any failure, the HTTP `status`, the number of
+        `attempts` made, the seconds of `backoff` before retrying and the
+        `latency` in seconds. Failures caused by
+        server errors or the network are retried up to `retries` times;
+        throttled requests have already been retried by the account's rate
+        limiter so a ThrottleError is not. If `stop` is true, changes after
+        the first failure are not made but left queued.
+
+        """
+        results = []
+        changes = self.changes
+        self.changes = []
+        for i in range(len(changes)):
+            (operation, key, path, query, error) = changes[i]
+            if stop and results and not results[-1]["ok"]:
+                self.changes = changes[i:]
+                break
+            result = {"operation": operation, "key": key, "ok": 0, \
+                    "skipped": 0, "error": None, "message": None, \
+                    "status": None, "attempts": 0, "backoff": 0.0, \
+                    "latency": 0.0}
+            results.append(result)
+            if operation == "add" and self.__unchanged(query):
+                if _debug:
+                    sys.stderr.write("Post, %s, is unchanged; skipping.\n" % key)
+                result["ok"] = 1
+                result["skipped"] = 1
+                continue
+            start = time.time()
+            while 1:
+                result["attempts"] += 1
+                transient = 0
+                try:
+                    self.account._change(path, query, error)
+                    result["ok"] = 1
+                    result["status"] = 200
+                    result["error"] = None
+                    result["message"] = None
+                    break
+                except ThrottleError, e:
+                    result["status"] = 503
+                    (result["error"], result["message"]) = (ThrottleError, str(e))
+                except DeliciousError, e:
+                    result["status"] = 200
+                    (result["error"], result["message"]) = (e.__class__, str(e))
+                except urllib2.HTTPError, e:
+                    (transient, result["status"]) = (e.code >= 500, e.code)
+                    (result["error"], result["message"]) = (urllib2.HTTPError, str(e))
+                except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+                    transient = 1
+                    (result["error"], result["message"]) = (e.__class__, str(e))
+
+                # Anything else (e.g. a malformed response) fails this change
+                # alone so that the results of the others are not lost.
+                except Exception, e:
+                    (result["error"], result["message"]) = (e.__class__, str(e))
+                if not transient or result["attempts"] > self.retries:
+                    break
+                result["backoff"] += \
+                        self.account.limiter.throttled(result["attempts"] - 1)
+            result["latency"] = time.time() - start
+        return results
+
+# Reconciling tags
+
+def _bundletags(tags):
+    """Return the tags of a bundle as a sorted list without duplicates"""
+    if StringTypes and isinstance(tags, StringTypes):
+        tags = tags.split()
+    unique = {}
+    for tag in tags:
+        if tag:
+            unique[tag] = 1
+    tags = unique.keys()
+    tags.sort()
+    return tags
+
+def _plantags(tags, bundles, renames, desired, prune=0):
+    """Return the changes to bring tags and bundles into a desired state
+
+    `tags` and `bundles` are the account's current tag names and bundles
+    (as a dictionary of names and lists of tags). Every tag in `renames` is
+    renamed to its value at the same time, so {"a": "b", "b": "c"} moves
+    the posts tagged b to c before moving those tagged a to b and swaps are
+    made through a temporary tag. Bundles in `desired` are set to their
+    tags or, if None, deleted; the tags of other bundles are renamed along
+    with the tags themselves and, if `prune` is true, they are deleted.
+    Each change is a tuple of a Batch method name and its arguments.
+
+    """
+    changes = []
+    existing = {}
+    for tag in tags:
+        existing[tag] = 1
+    pending = {}
+    for (old, new) in renames.items():
+        if old != new and existing.has_key(old):
+            pending[old] = new
+    while pending:
+        progress = 0
+        olds = pending.keys()
+        olds.sort()
+        for old in olds:
+
+            # A tag can only be renamed to one which has no posts of its own
+            # still waiting to be renamed (or else the two would merge).
+            if pending.has_key(pending[old]):
+                continue
+            changes.append(("rename_tag", (old, pending.pop(old))))
+            progress = 1
+        if not progress:
+            old = olds[0]
+            temporary = u"%s-renaming" % old
+            while existing.has_key(temporary) or pending.has_key(temporary):
+                temporary += u"-"
+            changes.append(("rename_tag", (old, temporary)))
+            pending[temporary] = pending.pop(old)
+
+    # Bundles are compared by their sets of tags once renamed.
+    wanted = {}
+    for (name, bundled) in bundles.items():
+        if not prune:
+            wanted[name] = _bundletags([renames.get(tag, tag) \
+                    for tag in _bundletags(bundled)])
+    for (name, bundled) in desired.items():
+        if bundled is None:
+            wanted.pop(name, None)
+        else:
+            wanted[name] = _bundletags(bundled)
+    names = wanted.keys()
+    names.sort()
+    for name in names:
+        if not bundles.has_key(name) or \
+                _bundletags(bundles[name]) != wanted[name]:
+            changes.append(("bundle", (name, wanted[name])))
+    names = bundles.keys()
+    names.sort()
+    for name in names:
+        if not wanted.has_key(name):
+            changes.append(("delete_bundle", (name,)))
+    return changes
+
+# Exporting and importing posts
+
+_netscapeheader = """<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<TITLE>Bookmarks</TITLE>
+<H1>Bookmarks</H1>
+<DL><p>
+"""
+
+def _record(post):
+    """Return a post as a dictionary suitable for JSON"""
+    record = _unparsed(post)
+    if record.has_key(u"tags"):
+        record[u"tags"] = [tag for tag in record[u"tags"] if tag]
+    return record
+
+def _netscape(post):
+    """Return a post as an entry of a Netscape bookmark file"""
+    entry = u"<DT><A HREF=\"%s\"" % escape(post.get(u"href", u""), {'"': "&quot;"})
+    if post.get(u"time"):
+        entry += u" ADD_DATE=\"%d\"" % calendar.timegm(post[u"time_parsed"])
+    tags = [tag for tag in post.get(u"tags", ()) if tag]
+    if tags:
+        entry += u" TAGS=\"%s\"" % escape(u",".join(tags), {'"': "&quot;"})
+    entry += u">%s</A>\n" % escape(post.get(u"description", u""))
+    if post.get(u"extended"):
+        entry += u"<DD>%s\n" % escape(post[u"extended"])
+    return entry.encode("utf-8")
+
+def _jsonrecords(fileobj):
+    """Yield each record of a JSON Lines file"""
+    for line in fileobj:
+        if line.strip():
+            yield json.loads(line)
+
+class _NetscapeParser(HTMLParser.HTMLParser):
+    """Collect the bookmarks of a Netscape bookmark file as records"""
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.records = []
+        self.text = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "a" and attrs.get("href"):
+            record = {u"href": attrs["href"], u"description": u"", \
+                    u"tags": [tag.strip() for tag in \
+                    attrs.get("tags", "").split(",") if tag.strip()]}
+            if attrs.get("add_date", "").isdigit():
+                record[u"time"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", \
+                        time.gmtime(int(attrs["add_date"])))
+            self.records.append(record)
+            self.text = u"description"
+        elif tag == "dd" and self.records:
+            self.records[-1][u"extended"] = u""
+            self.text = u"extended"
+        else:
+            self.text = None
+
+    def handle_endtag(self, tag):
+        if tag in ("a", "dd", "dl"):
+            self.text = None
+
+    def handle_data(self, data):
+        if self.text and self.records:
+            record = self.records[-1]
+            record[self.text] = record[self.text] + data
+
+    def handle_entityref(self, name):
+        if htmlentitydefs.name2codepoint.has_key(name):
+            self.handle_data(unichr(htmlentitydefs.name2codepoint[name]))
+
+    def handle_charref(self, name):
+        if name[:1] in ("x", "X"):
+            self.handle_data(unichr(int(name[1:], 16)))
+        else:
+            self.handle_data(unichr(int(name)))
+
+def _netscaperecords(fileobj):
+    """Yield each bookmark of a Netscape bookmark file as it is read"""
+    parser = _NetscapeParser()
+    reader = codecs.getreader("utf-8")(fileobj, "replace")
+    while 1:
+        chunk = reader.read(_chunksize)
+        if chunk:
+            parser.feed(chunk)
+        else:
+            parser.close()
+
+        # The last bookmark may still have more text (or notes) to come.
+        records = parser.records
+        if chunk:
+            parser.records = records[-1:]
+            records = records[:-1]
+        for record in records:
+            record[u"description"] = record[u"description"].strip()
+            if record.has_key(u"extended"):
+                record[u"extended"] = record[u"extended"].strip()
+            yield record
+        if not chunk:
+            break
+
+def _checkpoint(path, count):
+    """Record the number of records imported in a checkpoint file"""
+    temporary = "%s.tmp" % path
+    checkpoint = file(temporary, "w")
+    checkpoint.write("%d\n" % count)
+    checkpoint.close()
+    os.rename(temporary, path)
+
+# Syncing many accounts
+
+class _ChainedLimiter:
+    """A rate limiter that also waits for a second limiter
+
+    Used by sync_many() to keep accounts with their own limiters under its
+    overall limit without changing those limiters.
+
+    """
+
+    def __init__(self, limiter, parent):
+        self.limiter = limiter
+        self.parent = parent
+
+    def __getattr__(self, name):
+        return getattr(self.limiter, name)
+
+    def acquire(self):
+        return self.limiter.acquire() + self.parent.acquire()
+
+    def throttled(self, attempt, retryafter=None):
+        return max(self.limiter.throttled(attempt, retryafter), \
+                self.parent.throttled(attempt, retryafter))
+
+def _syncone(account, limiter):
+    """Sync one account for sync_many() and return its result"""
+    result = {"account": account, "ok": 0, "report": None, "error": None, \
+            "message": None, "started": time.time(), "time": 0.0}
+    try:
+        if isinstance(account, TupleType) or isinstance(account, ListType):
+            cache = None
+            if len(account) > 2:
+                cache = account[2]
+            account = DeliciousAccount(account[0], account[1], cache, \
+                    RateLimiter(parent=limiter))
+            result["account"] = account
+            result["report"] = account.sync()
+        elif account.limiter is limiter or \
+                getattr(account.limiter, "parent", None) is limiter:
+            result["report"] = account.sync()
+        else:
+            original = account.limiter
+            account.limiter = _ChainedLimiter(original, limiter)
+            try:
+                result["report"] = account.sync()
+            finally:
+                account.limiter = original
+        result["ok"] = 1
+    except Exception, e:
+        (result["error"], result["message"]) = (e.__class__, str(e))
+    result["time"] = time.time() - result["started"]
+    return result
+
+def sync_many(accounts, workers=4, limiter=None):
+    """Sync several accounts at once and return a list of results
+
+    Each account may be a DeliciousAccount or a tuple of the username,
+    password and (optionally) cache to open one with. Up to `workers`
+    accounts are synced at a time, each with its own credentials, rate
+    limiter and cache. Every request must also wait for `limiter` so that
+    together the accounts stay under its limit; by default it is a new
+    RateLimiter, as del.icio.us limits each client rather than each account.
+
+    Each result is a dictionary of the `account`, whether the sync was
+    `ok`, the `report` returned by sync(), the `error` class and `message`
+    of any failure and the time it `started` and took (`time`).
+
+    """
+    limiter = limiter or RateLimiter()
+    pool = ThreadPool(workers)
+    try:
+        futures = [pool.submit(_syncone, account, limiter) \
+                for account in accounts]
+        return [future.result() for future in futures]
+    finally:
+        pool.shutdown()
+
+
+# Asynchronous access
+
+class Future:
+    """The eventual result of a call made by an AsyncDeliciousAccount"""
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__result = None
+        self.__error = None
+        self.__callbacks = []
+
+    def done(self):
+        """Whether the call has finished"""
+        return self.__done.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return its result
+
+        Any exception raised by the call is raised again here.
+
+        """
+        self.__done.wait(timeout)
+        if not self.__done.isSet():
+            raise DeliciousError("Timed out waiting for a result")
+        if self.__error:
+            raise self.__error[0], self.__error[1], self.__error[2]
+        return self.__result
+
+    def add_callback(self, callback):
+        """Call `callback` with this future once it is done"""
+        self.__lock.acquire()
+        try:
+            if not self.__done.isSet():
+                self.__callbacks.append(callback)
+                return
+        finally:
+            self.__lock.release()
+        callback(self)
+
+    def _set(self, result=None, error=None):
+        self.__lock.acquire()
+        try:
+            self.__result = result
+            self.__error = error
+            self.__done.set()
+            callbacks = self.__callbacks
+            self.__callbacks = []
+        finally:
+            self.__lock.release()
+        for callback in callbacks:
+            callback(self)
+
+class ThreadPool:
+    """Worker threads running the calls of asynchronous accounts
+
+    A single pool may be shared by any number of accounts; calls for
+    different accounts run side by side while the calls for each account
+    run one at a time in the order they were made.
+
+    """
+
+    def __init__(self, workers=20):
+        self.__queue = Queue.Queue()
+        self.__threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.__work)
+            thread.setDaemon(1)
+            thread.start()
+            self.__threads.append(thread)
+
+    def __work(self):
+        while 1:
+            call = self.__queue.get()
+            if call is None:
+                break
+            (future, function, args, kwargs) = call
+            try:
+                future._set(function(*args, **kwargs))
+            except:
+                future._set(error=sys.exc_info())
+
+    def submit(self, function, *args, **kwargs):
+        """Run `function` in a worker thread and return a Future"""
+        future = Future()
+        self.__queue.put((future, function, args, kwargs))
+        return future
+
+    def shutdown(self):
+        """Stop the workers once the calls already submitted have run"""
+        for thread in self.__threads:
+            self.__queue.put(None)
+
+# The pool used by asynchronous accounts unless they are given another.
+_pool = None
+_poollock = threading.Lock()
+
+def _defaultpool():
+    global _pool
+    _poollock.acquire()
+    try:
+        if _pool is None:
+            _pool = ThreadPool()
+        return _pool
+    finally:
+        _poollock.release()
+
+# Marks the end of a stream of posts in its queue.
+_streamend = object()
+
+def _streamput(queue, closed, item):
+    """Put an item into the queue of a stream, returning 0 if it is closed"""
+    while not closed.isSet():
+        try:
+            queue.put(item, 1, 1)
+            return 1
+        except Queue.Full:
+            pass
+    return 0
+
+def _feedposts(queue, closed, posts):
+    """Put posts into the queue of a stream until they run out or it is closed"""
+    for postdict in posts:
+        if not _streamput(queue, closed, postdict):
+            posts.close()
+            return
+    _streamput(queue, closed, _streamend)
+
+class _PostStream:
+    """An iterator over posts downloaded by a worker thread
+
+    The worker only holds the queue and the flag closing it, not the stream,
+    so a stream that is dropped before being read to the end is closed when
+    it is garbage collected and the worker is freed.
+
+    """
+
+    def __init__(self, size):
+        self.queue = Queue.Queue(size)
+        self.closed = threading.Event()
+        self.future = None
+
+    def __del__(self):
+        self.closed.set()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while 1:
+            try:
+                postdict = self.queue.get(1, 1)
+                break
+            except Queue.Empty:
+                if self.future.done():
+                    # The download failed; raise its exception.
+                    self.future.result()
+                    raise StopIteration
+        if postdict is _streamend:
+            raise StopIteration
+        return postdict
+
+    def close(self):
+        """Stop downloading posts that have not been read yet"""
+        self.closed.set()
+
+class AsyncDeliciousAccount:
+    """A del.icio.us account whose methods return immediately
+
+    Takes the same arguments as DeliciousAccount (which does all of the
+    actual work) plus an optional ThreadPool, `pool`. Every method returns
+    a Future whose result() is what the DeliciousAccount method returns;
+    iterposts() returns an iterator over posts as they are downloaded.
+    The calls for one account are made one at a time in order so many
+    accounts may share a pool (and a rate limiter) without interfering;
+    each iterposts() download runs on a thread of its own so that a slow
+    reader holds up only its own account, not the pool.
+
+    """
+
+    def __init__(self, username, password, cache=None, limiter=None, \
+            staleness=None, compact=0, pool=None, outbox=None):
+        self.pool = pool or _defaultpool()
+        self.account = DeliciousAccount(username, password, cache, limiter, \
+                staleness, compact, outbox)
+        self.__lock = threading.Lock()
+        self.__calls = []
+
+    def __call(self, function, *args, **kwargs):
+        return self.__queue(0, function, args, kwargs)
+
+    def __queue(self, ownthread, function, args, kwargs):
+        """Queue a call, made on a thread of its own if `ownthread` is true"""
+        future = Future()
+        self.__lock.acquire()
+        try:
+            self.__calls.append((future, function, args, kwargs, ownthread))
+            first = len(self.__calls) == 1
+        finally:
+            self.__lock.release()
+        if first:
+            self.__next()
+        return future
+
+    def __next(self):
+        call = self.__calls[0]
+        if call[-1]:
+            thread = threading.Thread(target=self.__run, args=call[:-1])
+            thread.setDaemon(1)
+            thread.start()
+        else:
+            self.pool.submit(self.__run, *call[:-1])
+
+    def __run(self, future, function, args, kwargs):
+        try:
+            future._set(function(*args, **kwargs))
+        except:
+            future._set(error=sys.exc_info())
+        self.__lock.acquire()
+        try:
+            self.__calls.pop(0)
+            more = len(self.__calls)
+        finally:
+            self.__lock.release()
+        if more:
+            self.__next()
+
+    def __method(self, name, *args, **kwargs):
+        return self.__call(self.__invoke, name, args, kwargs)
+
+    def __invoke(self, name, args, kwargs):
+        return getattr(self.account, name)(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self.__method("__getitem__", key)
+
+    def lastupdate(self):
+        return self.__method("lastupdate")
+
+    def posts(self, tag="", date="", todt="", fromdt="", count=0):
+        return self.__method("posts", tag, date, todt, fromdt, count)
+
+    def iterposts(self, tag="", date="", todt="", fromdt="", count=0, \
+            size=1000):
+        """Return an iterator over posts as they are downloaded
+
+        Up to `size` posts are held waiting to be read. Call close() on the
+        iterator if it will not be read to the end; an iterator that is
+        dropped is closed when it is garbage collected.
+
+        """
+        stream = _PostStream(size)
+        stream.future = self.__queue(1, self.__stream, (stream.queue, \
+                stream.closed, tag, date, todt, fromdt, count), {})
+        return stream
+
+    def __stream(self, queue, closed, *args):
+        _feedposts(queue, closed, self.account.iterposts(*args))
+
+    def sync(self):
+        return self.__method("sync")
+
+    def tags(self):
+        return self.__method("tags")
+
+    def bundles(self):
+        return self.__method("bundles")
+
+    def dates(self, tag=""):
+        return self.__method("dates", tag)
+
+    def add(self, url, description, extended="", tags=(), date=""):
+        return self.__method("add", url, description, extended, tags, date)
+
+    def bundle(self, bundle, tags):
+        return self.__method("bundle", bundle, tags)
+
+    def delete(self, url):
+        return self.__method("delete", url)
+
+    def delete_bundle(self, name):
+        return self.__method("delete_bundle", name)
+
+    def rename_tag(self, old, new):
+        return self.__method("rename_tag", old, new)
+
+    def reconcile_tags(self, renames=None, merges=None, bundles=None, \
+            prune=0, dryrun=0, retries=3):
+        return self.__method("reconcile_tags", renames, merges, bundles, \
+                prune, dryrun, retries)
+
+    def search(self, query, limit=None):
+        return self.__method("search", query, limit)
+
+    def flush(self, timeout=None):
+        return self.__method("flush", timeout)
+
+    def close(self):
+        return self.__method("close")
+
+    def export(self, fileobj, format="jsonl"):
+        return self.__method("export", fileobj, format)
+
+    def import_(self, fileobj, format="jsonl", checkpoint=None, \
+            batchsize=100, retries=3):
+        return self.__method("import_", fileobj, format, checkpoint, \
+                batchsize, retries)
+
+    def related_tags(self, tag, n=10):
+        return self.__method("related_tags", tag, n)
+
+    def suggest_tags(self, url_or_tags, n=10):
+        return self.__method("suggest_tags", url_or_tags, n)
+
+
 if __name__ == "__main__":
     if sys.argv[1:][0] == '-v' or sys.argv[1:][0] == '--version':
         print __version__
@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+"""Mock del.icio.us
+
+A local stand-in for the del.icio.us API for testing and benchmarking
+Python-Delicious without touching the real servers. It serves a synthetic
+account of any size and can add latency and throttling to its responses.
+
+To use it from another program:
+
+    import delicious, mockdelicious
+    server = mockdelicious.start(posts=100000)
+    delicious.DELICIOUS_API = server.url
+
+or run it on its own with `python mockdelicious.py --posts 100000` and
+point DELICIOUS_API at the URL it prints.
+"""
+
+__version__ = "pre-1.0"
+__license__ = "BSD"
+__copyright__ = "Copyright 2005-2008, Paul Mucur"
+__author__ = "Paul Mucur <http://mucur.name/>"
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import cgi
+import calendar
+import time
+import zlib
+import md5
+import re
+import sys
+import socket
+from xml.sax.saxutils import quoteattr
+
+# The number of posts written to a response at a time.
+_batchsize = 500
+
+# Synthetic posts are this many seconds apart, counting back from the time
+# the account was created.
+_spacing = 4321
+
+
+class MockAccount:
+    """A synthetic del.icio.us account
+
+    The first `size` posts are generated on demand from their position so
+    that even very large accounts take little memory; only posts that have
+    been added, edited or deleted since are stored.
+
+    """
+
+    def __init__(self, size=1000, tags=500, domains=100):
+        self.size = size
+        self.vocabulary = ["tag%d" % i for i in range(tags)]
+        self.domains = domains
+        self.start = int(time.time()) // 86400 * 86400
+        self.deleted = {}
+        self.extra = {}
+        self.renames = {}
+        self.bundles = {}
+        self.version = 0
+        self.lastupdate = self.__format(self.start)
+        self.lock = threading.RLock()
+
+        # Tag and date counts are kept up to date as the account changes.
+        self.tagcounts = {}
+        self.datecounts = {}
+        for i in xrange(size):
+            self.__count(self.generate(i), 1)
+
+    def __format(self, seconds):
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+    def __count(self, post, change):
+        for tag in post["tag"].split(" "):
+            count = self.tagcounts.get(tag, 0) + change
+            if count:
+                self.tagcounts[tag] = count
+            else:
+                self.tagcounts.pop(tag, None)
+        day = post["time"][:10]
+        count = self.datecounts.get(day, 0) + change
+        if count:
+            self.datecounts[day] = count
+        else:
+            self.datecounts.pop(day, None)
+
+    def generate(self, i):
+        """Return the i-th synthetic post (the newest is the 0th)"""
+        href = "http://example%d.com/page/%d" % (i % self.domains, i)
+        tags = []
+        for k in range(1 + i % 4):
+            tag = self.vocabulary[(i * 7 + k * 13) % len(self.vocabulary)]
+            tag = self.renames.get(tag, tag)
+            if tag not in tags:
+                tags.append(tag)
+        extended = ""
+        if i % 3 == 0:
+            extended = "Notes about bookmark %d" % i
+        return {"href": href, "description": "Bookmark %d" % i, \
+                "extended": extended, "hash": md5.new(href).hexdigest(), \
+                "tag": " ".join(tags), "others": str(i % 50), \
+                "time": self.__format(self.start - i * _spacing)}
+
+    def get(self, href):
+        """Return the post for a URL or None"""
+        if self.extra.has_key(href):
+            return self.extra[href]
+        match = re.match(r"http://example\d+\.com/page/(\d+)$", href)
+        if match and int(match.group(1)) < self.size and \
+                not self.deleted.has_key(href):
+            return self.generate(int(match.group(1)))
+        return None
+
+    def posts(self, tag="", dt="", fromdt="", todt="", count=0):
+        """Iterate over the posts matching the arguments of posts/*"""
+        indexes = xrange(self.size)
+        if dt:
+            day = calendar.timegm(time.strptime(dt, "%Y-%m-%d"))
+            first = max(0, (self.start - day - 86399 + _spacing - 1) // _spacing)
+            last = min(self.size, (self.start - day) // _spacing + 1)
+            indexes = xrange(first, max(first, last))
+        extra = self.extra.values()
+        extra.sort(lambda a, b: cmp(b["time"], a["time"]))
+        returned = 0
+        for post in self.__generated(indexes, extra):
+            if tag and tag not in post["tag"].split(" "):
+                continue
+            if dt and post["time"][:10] != dt:
+                continue
+            if fromdt and post["time"] < fromdt:
+                continue
+            if todt and post["time"] > todt:
+                continue
+            yield post
+            returned += 1
+            if count and returned >= count:
+                break
+
+    def __generated(self, indexes, extra):
+        for i in indexes:
+            post = self.generate(i)
+            if not self.deleted.has_key(post["href"]):
+                yield post
+        for post in extra:
+            yield post
+
+    def __changed(self):
+        self.version += 1
+        self.lastupdate = self.__format(max(time.time(), \
+                self.start + self.version))
+
+    def add(self, url, description, extended="", tags="", dt="", \
+            replace="yes"):
+        """Add or replace a post, returning the result code"""
+        self.lock.acquire()
+        try:
+            existing = self.get(url)
+            if existing and replace == "no":
+                return "item already exists"
+            if existing:
+                self.__remove(existing)
+            post = {"href": url, "description": description, \
+                    "extended": extended, "hash": md5.new(url).hexdigest(), \
+                    "tag": " ".join(tags.split()), "others": "0", \
+                    "time": dt or self.__format(time.time())}
+            self.extra[url] = post
+            self.__count(post, 1)
+            self.__changed()
+            return "done"
+        finally:
+            self.lock.release()
+
+    def __remove(self, post):
+        self.__count(post, -1)
+        self.extra.pop(post["href"], None)
+        self.deleted[post["href"]] = 1
+
+    def delete(self, url):
+        """Delete a post, returning the result code"""
+        self.lock.acquire()
+        try:
+            existing = self.get(url)
+            if existing:
+                self.__remove(existing)
+                self.__changed()
+            return "done"
+        finally:
+            self.lock.release()
+
+    def rename(self, old, new):
+        """Rename a tag on every post, returning the result code"""
+        self.lock.acquire()
+        try:
+            for (tag, renamed) in self.renames.items():
+                if renamed == old:
+                    self.renames[tag] = new
+            if old in self.vocabulary:
+                self.renames[old] = new
+            for post in self.extra.values():
+                tags = post["tag"].split(" ")
+                if old in tags:
+                    tags = [tag for tag in tags if tag != old]
+                    if new not in tags:
+                        tags.append(new)
+                    post["tag"] = " ".join(tags)
+            if self.tagcounts.has_key(old):
+                self.tagcounts[new] = self.tagcounts.get(new, 0) + \
+                        self.tagcounts.pop(old)
+            self.__changed()
+            return "done"
+        finally:
+            self.lock.release()
+
+    def change(self, count):
+        """Edit, delete and add `count` posts in all, for testing syncs"""
+        for i in range(count):
+            if i % 3 == 0:
+                post = self.get("http://example%d.com/page/%d" \
+                        % (i % self.domains, i))
+                if post:
+                    self.delete(post["href"])
+            else:
+                self.add("http://changed.example.com/%d/%d" % (self.version, i), \
+                        "Changed bookmark %d" % i, tags="changed")
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle requests to the mock API"""
+
+    protocol_version = "HTTP/1.1"
+
+    # Buffer writes so that small responses go out in one packet.
+    wbufsize = 65536
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        server = self.server
+        (path, query) = urlparse.urlsplit(self.path)[2:4]
+        query = dict(cgi.parse_qsl(query))
+        if path == "/stats":
+            return self.__stats()
+        if path == "/change":
+            server.account.change(int(query.get("count", 10)))
+            return self.__send(200, ["<result code=\"done\" />"])
+        server.count(path)
+        if server.latency:
+            time.sleep(server.latency)
+        if not self.headers.get("authorization"):
+            return self.__send(401, ["Authorization required"], \
+                    {"WWW-Authenticate": "Basic realm=\"del.icio.us API\""})
+        if server.throttle and server.requests % server.throttle == 0:
+            return self.__send(503, ["Throttled"], \
+                    {"Retry-After": str(server.retryafter)})
+        account = server.account
+        method = path.split("/v1/", 1)[-1]
+        if method == "posts/update":
+            body = ["<update time=\"%s\" />" % account.lastupdate]
+        elif method in ("posts/all", "posts/get", "posts/recent"):
+            count = int(query.get("count", 0))
+            if method == "posts/recent" and not count:
+                count = 15
+            body = self.__posts(account.posts(query.get("tag", ""), \
+                    query.get("dt", ""), query.get("fromdt", ""), \
+                    query.get("todt", ""), count))
+        elif method == "posts/dates":
+            if query.get("tag"):
+                counts = {}
+                for post in account.posts(query["tag"]):
+                    counts[post["time"][:10]] = counts.get(post["time"][:10], 0) + 1
+            else:
+                counts = account.datecounts
+            body = ["<dates>"] + ["<date count=\"%d\" date=\"%s\" />" % (count, day) \
+                    for (day, count) in counts.items()] + ["</dates>"]
+        elif method == "tags/get":
+            body = ["<tags>"] + ["<tag count=\"%d\" tag=%s />" % (count, quoteattr(tag)) \
+                    for (tag, count) in account.tagcounts.items()] + ["</tags>"]
+        elif method == "tags/bundles/all":
+            body = ["<bundles>"] + ["<bundle name=%s tags=%s />" % (quoteattr(name), \
+                    quoteattr(tags)) for (name, tags) in account.bundles.items()] + \
+                    ["</bundles>"]
+        elif method == "posts/add":
+            body = self.__result(account.add(query.get("url", ""), \
+                    query.get("description", ""), query.get("extended", ""), \
+                    query.get("tags", ""), query.get("dt", ""), \
+                    query.get("replace", "yes")))
+        elif method == "posts/delete":
+            body = self.__result(account.delete(query.get("url", "")))
+        elif method == "tags/rename":
+            body = self.__result(account.rename(query.get("old", ""), \
+                    query.get("new", "")))
+        elif method == "tags/bundles/set":
+            account.bundles[query.get("bundle", "")] = query.get("tags", "")
+            body = self.__result("done")
+        elif method == "tags/bundles/delete":
+            account.bundles.pop(query.get("bundle", ""), None)
+            body = self.__result("done")
+        else:
+            return self.__send(404, ["Not found"])
+
+        # Responses are only the same for as long as the account is.
+        etag = "\"%d-%s\"" % (account.version, md5.new(self.path).hexdigest())
+        if server.validators and self.headers.get("if-none-match") == etag:
+            return self.__send(304, [], {"ETag": etag})
+        headers = {}
+        if server.validators:
+            headers["ETag"] = etag
+        self.__send(200, body, headers)
+
+    def __result(self, code):
+        return ["<result code=%s />" % quoteattr(code)]
+
+    def __posts(self, posts):
+        yield "<?xml version='1.0' standalone='yes'?>\n<posts user=\"mock\">"
+        chunk = []
+        for post in posts:
+            chunk.append("<post %s />" % " ".join(["%s=%s" % (name, \
+                    quoteattr(value)) for (name, value) in post.items()]))
+            if len(chunk) >= _batchsize:
+                yield "\n".join(chunk)
+                chunk = []
+        chunk.append("</posts>")
+        yield "\n".join(chunk)
+
+    def __stats(self):
+        server = self.server
+        lines = ["requests %d" % server.requests, "bytes %d" % server.sent]
+        for (path, count) in server.paths.items():
+            lines.append("path %s %d" % (path, count))
+        self.__send(200, ["\n".join(lines)], count=0)
+
+    def __send(self, status, body, headers={}, count=1):
+        """Send a response, chunked and gzipped if the client allows"""
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        if status == 304:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        compressor = None
+        if self.server.gzip and \
+                "gzip" in self.headers.get("accept-encoding", ""):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for data in body:
+            if compressor:
+                data = compressor.compress(data)
+            self.__chunk(data, count)
+        if compressor:
+            self.__chunk(compressor.flush(), count)
+        self.wfile.write("0\r\n\r\n")
+
+    def __chunk(self, data, count):
+        if data:
+            self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+            if count:
+                self.server.received(len(data))
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A mock del.icio.us API server
+
+    `latency` seconds are added to every response and, if `throttle` is
+    given, every throttle-th request is refused with a 503 status asking
+    for a retry after `retryafter` seconds. Responses are gzipped for
+    clients that ask unless `gzip` is false and carry ETags unless
+    `validators` is false. The number of requests and bytes of response
+    bodies sent are counted in `requests` and `sent`.
+
+    """
+
+    daemon_threads = 1
+    allow_reuse_address = 1
+
+    def __init__(self, address, account, latency=0, throttle=0, \
+            retryafter=1, gzip=1, validators=1, verbose=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockHandler)
+        self.account = account
+        self.latency = latency
+        self.throttle = throttle
+        self.retryafter = retryafter
+        self.gzip = gzip
+        self.validators = validators
+        self.verbose = verbose
+        self.requests = 0
+        self.sent = 0
+        self.paths = {}
+        self.url = "http://%s:%d/v1" % (self.server_address[0], \
+                self.server_address[1])
+        self.__lock = threading.Lock()
+
+    def count(self, path):
+        self.__lock.acquire()
+        try:
+            self.requests += 1
+            self.paths[path] = self.paths.get(path, 0) + 1
+        finally:
+            self.__lock.release()
+
+    def handle_error(self, request, address):
+        # Clients that stop reading part way through a response are normal.
+        if self.verbose or not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, address)
+
+    def received(self, count):
+        self.__lock.acquire()
+        try:
+            self.sent += count
+        finally:
+            self.__lock.release()
+
+
+def start(posts=1000, port=0, **options):
+    """Start a mock server in a background thread and return it
+
+    The API is at server.url and is served from server.account; `options`
+    are passed to MockServer.
+
+    """
+    server = MockServer(("127.0.0.1", port), MockAccount(posts), **options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(1)
+    thread.start()
+    return server
+
+
+def main(args):
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--posts", type="int", default=1000, \
+            help="number of posts in the account")
+    parser.add_option("--port", type="int", default=8080)
+    parser.add_option("--latency", type="float", default=0, \
+            help="seconds added to every response")
+    parser.add_option("--throttle", type="int", default=0, \
+            help="refuse every Nth request with a 503")
+    parser.add_option("--retry-after", type="int", default=1, dest="retryafter")
+    parser.add_option("--no-gzip", action="store_false", default=1, dest="gzip")
+    parser.add_option("--no-validators", action="store_false", default=1, \
+            dest="validators")
+    parser.add_option("--verbose", action="store_true", default=0)
+    (options, args) = parser.parse_args(args)
+    server = MockServer(("127.0.0.1", options.port), MockAccount(options.posts), \
+            options.latency, options.throttle, options.retryafter, \
+            options.gzip, options.validators, options.verbose)
+    print "Serving %d posts at %s" % (options.posts, server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -6,4 +6,4 @@ setup(name='Python-Delicious',
     version='pre-1.0',
     description='Python module to access del.icio.us via its API',
     author='Paul Mucur',
-    py_modules=['delicious'])
+    py_modules=['delicious', 'mockdelicious'])
@@ -0,0 +1,792 @@
+#!/usr/bin/env python
+"""Tests for Python-Delicious
+
+Runs against a local mock del.icio.us (see mockdelicious.py) so no network
+access or account is needed:
+
+    python test_delicious.py
+"""
+
+import os
+import gc
+import time
+import tempfile
+import unittest
+import StringIO
+import gzip
+import rfc822
+import threading
+
+import delicious
+import mockdelicious
+
+# One mock server is shared by every test; each test gives it a new account.
+_server = None
+
+def _mock(posts=0):
+    """Return the mock server, serving a new account of `posts` posts"""
+    global _server
+    if _server is None:
+        _server = mockdelicious.start(posts)
+    _server.account = mockdelicious.MockAccount(posts)
+    _server.paths.clear()
+    (_server.latency, _server.throttle, _server.retryafter) = (0, 0, 1)
+    _server.requests = 0
+    delicious.DELICIOUS_API = _server.url
+    return _server
+
+def _limiter():
+    return delicious.RateLimiter(rate=10000, burst=10000, retries=1, \
+            backoff=0.01, maxbackoff=0.05)
+
+def _account(**options):
+    return delicious.open("test", "test", limiter=_limiter(), **options)
+
+def _post(href, description="", tags=(), extended="", \
+        time="2008-01-01T00:00:00Z"):
+    return {u"href": href, u"description": description, u"tags": list(tags), \
+            u"extended": extended, u"time": time}
+
+
+class TemporaryFiles:
+    """Removes the temporary files a test asked for once it has finished"""
+
+    def temporary(self, suffix=""):
+        (fd, path) = tempfile.mkstemp(suffix)
+        os.close(fd)
+        os.remove(path)
+        self.temporaries.append(path)
+        return path
+
+    def setUp(self):
+        self.temporaries = []
+
+    def tearDown(self):
+        for path in self.temporaries:
+            for name in (path, path + ".tmp"):
+                if os.path.exists(name):
+                    os.remove(name)
+
+
+class ChunkedReader:
+    """A response returning at most `size` bytes from each read"""
+
+    def __init__(self, data, size):
+        self.data = StringIO.StringIO(data)
+        self.size = size
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.data.read()
+        return self.data.read(min(size, self.size))
+
+    def close(self):
+        pass
+
+
+class IterparseTest(unittest.TestCase):
+
+    document = u"<?xml version='1.0' encoding='UTF-8'?>\n<posts>" + \
+            u"".join([u"<post href=\"http://example.com/%d\" " \
+            u"description=\"Caf\xe9 &amp; %d\" tag=\"a b\" />" % (i, i) \
+            for i in range(50)]) + u"</posts>"
+    document = document.encode("utf-8")
+
+    def setUp(self):
+        self.chunksize = delicious._chunksize
+
+    def tearDown(self):
+        delicious._chunksize = self.chunksize
+
+    def parse(self, response):
+        return [dict(attrs) for attrs in delicious._iterparse(response, u"post")]
+
+    def testChunkBoundaries(self):
+        expected = self.parse(StringIO.StringIO(self.document))
+        self.assertEqual(len(expected), 50)
+        self.assertEqual(expected[7][u"description"], u"Caf\xe9 & 7")
+
+        # Every size splits elements, entities and UTF-8 characters somewhere.
+        for size in (1, 2, 3, 7, 64, 1000):
+            delicious._chunksize = size
+            self.assertEqual(self.parse(ChunkedReader(self.document, size)), \
+                    expected)
+
+    def testGzipChunks(self):
+        compressed = StringIO.StringIO()
+        writer = gzip.GzipFile(fileobj=compressed, mode="wb")
+        writer.write(self.document)
+        writer.close()
+        expected = self.parse(StringIO.StringIO(self.document))
+        for size in (1, 5, 100):
+            delicious._chunksize = size
+            response = delicious._GzipReader(ChunkedReader( \
+                    compressed.getvalue(), size))
+            self.assertEqual(self.parse(response), expected)
+
+
+class IndexedListTest(unittest.TestCase):
+
+    def testRemove(self):
+        posts = delicious.PostList([_post(u"http://example.com/%d" % i, \
+                tags=(u"t%d" % (i % 3),)) for i in range(20)])
+        posts.remove(u"http://example.com/3")
+        posts.remove(posts[0])
+        posts.sort(key=lambda post: post[u"href"], reverse=True)
+        posts.remove(u"http://example.com/19")
+        posts.remove(u"http://example.com/10")
+        hrefs = [post[u"href"] for post in posts]
+        hrefs.sort()
+        self.assertEqual(hrefs, [u"http://example.com/%d" % i \
+                for i in (1, 11, 12, 13, 14, 15, 16, 17, 18, 2, 4, 5, 6, 7, 8, 9)])
+        self.assertEqual(len(posts.tagged(u"t0")), 5)
+        for post in posts:
+            self.failUnless(post in posts)
+        self.assertRaises(KeyError, posts.remove, u"http://example.com/3")
+
+
+class RequestTest(TemporaryFiles, unittest.TestCase):
+
+    def setUp(self):
+        TemporaryFiles.setUp(self)
+        self.server = _mock(50)
+
+    def testCachedPosts(self):
+        if delicious.sqlite3 is None:
+            return
+        cache = self.temporary(".db")
+        _account(cache=cache).posts()
+        self.server.paths.clear()
+        self.assertEqual(len(_account(cache=cache).posts()), 50)
+        self.assertEqual(self.server.paths, {"/v1/posts/update": 1})
+
+    def testRevalidation(self):
+        account = _account()
+        events = []
+        account.hooks.append(events.append)
+        account.tags()
+        del account["tags"]
+        account.tags()
+        self.assertEqual([event["cached"] for event in events], [0, 1])
+
+        # Responses to changes are never stored.
+        account.add("http://a.example/", "A")
+        stored = account._DeliciousAccount__responses.keys()
+        self.assertEqual([url for url in stored if "posts/add" in url], [])
+
+    def testReconnect(self):
+        account = _account()
+        events = []
+        account.hooks.append(events.append)
+        account.tags()
+
+        # The kept-alive connection is closed behind the pool's back.
+        for idle in account.connections._ConnectionPool__idle.values():
+            for connection in idle:
+                connection.sock.close()
+        account.bundles()
+        self.assertEqual([event["reconnected"] for event in events], [0, 1])
+        self.assertEqual(events[1]["status"], 200)
+
+    def testNoConnectionTimeout(self):
+        # Connections of Python 2.5 and earlier do not take a timeout.
+        connections = []
+        original = delicious.httplib.HTTPConnection
+        class OldConnection(original):
+            def __init__(self, host):
+                original.__init__(self, host)
+                connections.append(self)
+        delicious.httplib.HTTPConnection = OldConnection
+        try:
+            account = _account()
+            account.connections.timeout = 7
+            self.assertEqual(len(account.tags()), len(_account().tags()))
+        finally:
+            delicious.httplib.HTTPConnection = original
+        self.assertEqual(connections[0].sock.gettimeout(), 7)
+
+    def testFailingHook(self):
+        account = _account()
+        account.posts()
+        def failing(event):
+            raise ValueError("failing hook")
+        account.hooks.append(failing)
+        result = account.batch().add("http://a.example/", "A").run()[0]
+        self.failUnless(result["ok"])
+        self.failUnless("http://a.example/" in account["posts"])
+
+
+class RateLimiterTest(TemporaryFiles, unittest.TestCase):
+
+    def setUp(self):
+        TemporaryFiles.setUp(self)
+        self.server = _mock(10)
+
+    def testBurst(self):
+        limiter = delicious.RateLimiter(rate=10, burst=2)
+        self.assertEqual((limiter.acquire(), limiter.acquire()), (0, 0))
+        self.failUnless(0.05 < limiter.acquire() <= 0.1)
+
+    def testRetryAfterSeconds(self):
+        limiter = delicious.RateLimiter(rate=10, backoff=100)
+        self.assertEqual(limiter.throttled(0, "2"), 2.0)
+
+    def testRetryAfterDate(self):
+        limiter = delicious.RateLimiter(rate=10, backoff=100)
+        delay = limiter.throttled(0, rfc822.formatdate(time.time() + 30))
+        self.failUnless(28 < delay <= 30)
+        self.assertEqual(limiter.throttled(0, rfc822.formatdate(0)), 0)
+
+        # Anything else falls back to the exponential backoff.
+        self.failUnless(50 <= limiter.throttled(0, "soon") <= 100)
+
+    def testDrain(self):
+        # Throttling empties the bucket for every user of the limiter.
+        limiter = delicious.RateLimiter(rate=10, burst=5)
+        limiter.throttled(0, "0.3")
+        self.failUnless(limiter.acquire() >= 0.3)
+
+    def testLockfile(self):
+        if delicious.fcntl is None:
+            return
+        lockfile = self.temporary(".lock")
+        first = delicious.RateLimiter(rate=10, burst=1, lockfile=lockfile)
+        second = delicious.RateLimiter(rate=10, burst=1, lockfile=lockfile)
+        self.assertEqual(first.acquire(), 0)
+        self.failUnless(0.05 < second.acquire() <= 0.1)
+        first.throttled(0, "0.3")
+        self.failUnless(second.acquire() >= 0.3)
+
+    def testThrottleError(self):
+        (self.server.throttle, self.server.retryafter) = (1, 0)
+        limiter = delicious.RateLimiter(rate=10000, burst=10000, retries=2, \
+                backoff=0.01)
+        account = delicious.open("test", "test", limiter=limiter)
+        self.assertRaises(delicious.ThrottleError, account.tags)
+        self.assertEqual(self.server.paths, {"/v1/tags/get": 3})
+
+    def testRetryAfterWait(self):
+        # Every second request is throttled for a second.
+        (self.server.throttle, self.server.retryafter) = (2, 1)
+        account = _account()
+        events = []
+        account.hooks.append(events.append)
+        account.tags()
+        started = time.time()
+        account.bundles()
+        self.failUnless(time.time() - started >= 1)
+        self.assertEqual([event["retries"] for event in events], [0, 1])
+        self.failUnless(events[1]["waited"] >= 1)
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _mock(10)
+
+    def testMalformedResponse(self):
+        account = _account()
+        change = account._change
+        def malformed(path, query, error):
+            if query["url"] == "http://b.example/":
+                raise IndexError("list index out of range")
+            return change(path, query, error)
+        account._change = malformed
+        results = account.batch().add("http://a.example/", "A") \
+                .add("http://b.example/", "B").add("http://c.example/", "C") \
+                .run()
+        self.assertEqual([result["ok"] for result in results], [1, 0, 1])
+        self.assertEqual((results[1]["error"], results[1]["attempts"]), \
+                (IndexError, 1))
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _mock(300)
+
+    def assertMatchesServer(self, account):
+        local = {}
+        for post in account["posts"]:
+            local[post[u"href"]] = (post[u"description"], post[u"time"])
+        remote = {}
+        for post in self.server.account.posts():
+            remote[post["href"]] = (post["description"], post["time"])
+        self.assertEqual(local, remote)
+
+    def testAddUpdateDelete(self):
+        account = _account()
+        account.posts()
+        server = self.server.account
+
+        # One post is deleted and another edited on the same day, so that
+        # day's count changes and its posts are fetched again.
+        first = server.generate(10)
+        second = server.generate(11)
+        self.assertEqual(first["time"][:10], second["time"][:10])
+        server.delete(first["href"])
+        server.add(second["href"], "Edited", tags="edited", dt=second["time"])
+        server.add("http://new.example.com/", "New", tags="new")
+        report = account.sync()
+        self.assertEqual((report["added"], report["updated"], \
+                report["deleted"]), (1, 1, 1))
+        self.assertEqual(account["posts"].get(second["href"])[u"tags"], \
+                [u"edited"])
+        self.failIf(first["href"] in account["posts"])
+        self.assertMatchesServer(account)
+
+    def testUnchanged(self):
+        account = _account()
+        account.posts()
+        report = account.sync()
+        self.assertEqual((report["requests"], report["dates"]), (1, 0))
+
+    def testManyChanges(self):
+        account = _account(compact=1)
+        account.sync()
+        self.server.account.change(30)
+        account.sync()
+        self.assertMatchesServer(account)
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.posts = delicious.PostList([
+                _post(u"http://python.org/", u"Python programming", \
+                        (u"python", u"programming")),
+                _post(u"http://perl.org/", u"Perl programming", \
+                        (u"perl", u"programming")),
+                _post(u"http://ruby-lang.org/", u"Ruby", (u"ruby",)),
+                _post(u"http://pypi.python.org/", u"Package index", \
+                        (u"python", u"packages")),
+                _post(u"http://example.com/", u"Cooking recipes", \
+                        (u"food",), u"Programming for the kitchen")])
+
+    def search(self, query):
+        hrefs = [post[u"href"] for post in self.posts.search(query)]
+        hrefs.sort()
+        return hrefs
+
+    def testAnd(self):
+        self.assertEqual(self.search(u"python programming"), \
+                [u"http://python.org/"])
+
+    def testOr(self):
+        self.assertEqual(self.search(u"perl OR ruby"), \
+                [u"http://perl.org/", u"http://ruby-lang.org/"])
+
+    def testNot(self):
+        self.assertEqual(self.search(u"programming NOT python"), \
+                [u"http://example.com/", u"http://perl.org/"])
+        self.assertEqual(self.search(u"programming -perl -food"), \
+                [u"http://python.org/"])
+
+    def testPrefix(self):
+        self.assertEqual(self.search(u"program*"), [u"http://example.com/", \
+                u"http://perl.org/", u"http://python.org/"])
+
+    def testGrouping(self):
+        self.assertEqual(self.search(u"(perl OR python) programming"), \
+                [u"http://perl.org/", u"http://python.org/"])
+        self.assertEqual(self.search(u"python NOT (packages OR perl)"), \
+                [u"http://python.org/"])
+
+    def testTag(self):
+        self.assertEqual(self.search(u"tag:python"), \
+                [u"http://pypi.python.org/", u"http://python.org/"])
+
+    def testRanking(self):
+        # The tag outweighs the word in another post's notes.
+        self.assertEqual(self.posts.search(u"programming")[-1][u"href"], \
+                u"http://example.com/")
+
+    def testChanges(self):
+        self.search(u"python")
+        self.posts.remove(u"http://python.org/")
+        self.posts.append(_post(u"http://jython.org/", u"Jython", \
+                (u"python", u"java")))
+        self.assertEqual(self.search(u"tag:python"), \
+                [u"http://jython.org/", u"http://pypi.python.org/"])
+
+
+class PlanTagsTest(unittest.TestCase):
+
+    def apply(self, tagged, changes):
+        """Make planned renames to a dictionary of tags and their posts"""
+        tagged = dict([(tag, set(posts)) for (tag, posts) in tagged.items()])
+        for (method, args) in changes:
+            if method == "rename_tag":
+                (old, new) = args
+                tagged[new] = tagged.get(new, set()) | tagged.pop(old)
+        return tagged
+
+    def plan(self, tagged, renames):
+        changes = delicious._plantags(tagged.keys(), {}, renames, {})
+        return (changes, self.apply(tagged, changes))
+
+    def testChain(self):
+        (changes, tagged) = self.plan({"a": [1], "b": [2], "c": [3]}, \
+                {"a": "b", "b": "c"})
+        self.assertEqual(changes, [("rename_tag", ("b", "c")), \
+                ("rename_tag", ("a", "b"))])
+        self.assertEqual(tagged, {"b": set([1]), "c": set([2, 3])})
+
+    def testSwap(self):
+        (changes, tagged) = self.plan({"a": [1], "b": [2]}, \
+                {"a": "b", "b": "a"})
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(tagged, {"a": set([2]), "b": set([1])})
+
+    def testCycle(self):
+        (changes, tagged) = self.plan({"a": [1], "b": [2], "c": [3], \
+                "a-renaming": [4]}, {"a": "b", "b": "c", "c": "a"})
+        self.assertEqual(tagged, {"a": set([3]), "b": set([1]), \
+                "c": set([2]), "a-renaming": set([4])})
+
+    def testBundles(self):
+        changes = delicious._plantags(["a", "b"], {"old": "a b", "keep": "b"}, \
+                {"a": "z"}, {"new": ["b", "a"], "keep": None})
+        self.assertEqual(changes, [("rename_tag", ("a", "z")), \
+                ("bundle", ("new", ["a", "b"])), \
+                ("bundle", ("old", ["b", "z"])), \
+                ("delete_bundle", ("keep",))])
+
+    def testReconcile(self):
+        server = _mock(200)
+        account = _account()
+        account.posts()
+        account.reconcile_tags(renames={"tag1": "tag2", "tag2": "tag1"})
+        fresh = _account()
+        self.assertEqual([post[u"tags"] for post in account.posts()], \
+                [post[u"tags"] for post in fresh.posts()])
+
+    def testReconcileCurrent(self):
+        server = _mock(20)
+        account = _account()
+        account.tags()
+        account.bundles()
+        server.account.add("http://other.example/", "Other", "", "fresh")
+        self.assertEqual(account.reconcile_tags(renames={"fresh": "renamed"}, \
+                dryrun=1), [("rename_tag", ("fresh", "renamed"))])
+        self.assertRaises(delicious.RenameTagError, account.reconcile_tags, \
+                renames={"missing": "renamed"}, dryrun=1)
+        account.reconcile_tags(renames={"fresh": "renamed"})
+        self.assertEqual(account.reconcile_tags(renames={"fresh": "renamed"}, \
+                dryrun=1), [])
+
+
+class ExportImportTest(TemporaryFiles, unittest.TestCase):
+
+    def setUp(self):
+        TemporaryFiles.setUp(self)
+        self.server = _mock(120)
+        self.server.account.add(u"http://q.example/?a=1&b=2".encode("utf-8"), \
+                u"Caf\xe9 <b>\"bold\"</b> & co".encode("utf-8"), \
+                "notes & <stuff>", u"t\xe9 x".encode("utf-8"))
+
+    def posts(self):
+        posts = {}
+        for post in _account().iterposts():
+            posts[post[u"href"]] = (post[u"description"], \
+                    post.get(u"extended", u""), post[u"tags"], post[u"time"])
+        return posts
+
+    def roundtrip(self, format):
+        exported = StringIO.StringIO()
+        self.assertEqual(_account().export(exported, format), 121)
+        before = self.posts()
+        _mock(0)
+        report = _account().import_(StringIO.StringIO(exported.getvalue()), \
+                format)
+        self.assertEqual((report["read"], report["added"], report["failure"]), \
+                (121, 121, None))
+        self.assertEqual(self.posts(), before)
+
+    def testJsonLines(self):
+        if delicious.json is None:
+            return
+        self.roundtrip("jsonl")
+
+    def testNetscape(self):
+        self.roundtrip("netscape")
+
+    def testCheckpoint(self):
+        exported = StringIO.StringIO()
+        _account().export(exported, "netscape")
+        server = _mock(0)
+        checkpoint = self.temporary()
+
+        # The server refuses posts after the first 50, stopping the import.
+        add = server.account.add
+        def failing(*args):
+            if len(server.account.extra) >= 50:
+                return "something went wrong"
+            return add(*args)
+        server.account.add = failing
+        report = _account().import_(StringIO.StringIO(exported.getvalue()), \
+                "netscape", checkpoint, batchsize=20)
+        self.assertEqual(report["added"], 50)
+        self.failUnless(report["failure"])
+        self.assertEqual(int(open(checkpoint).read()), 50)
+
+        # Resuming only adds the posts after the checkpoint.
+        server.account.add = add
+        server.paths.clear()
+        report = _account().import_(StringIO.StringIO(exported.getvalue()), \
+                "netscape", checkpoint, batchsize=20)
+        self.assertEqual((report["added"], report["skipped"], \
+                report["failure"]), (71, 50, None))
+        self.assertEqual(server.paths["/v1/posts/add"], 71)
+        self.assertEqual(len(server.account.extra), 121)
+
+
+class ReadCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _mock(50)
+
+    def account(self, reads):
+        account = _account()
+        account.reads = reads
+        return account
+
+    def hits(self, method):
+        return self.server.paths.get("/v1/%s" % method, 0)
+
+    def concurrently(self, function, count=5):
+        """Call function() from `count` threads at once, returning results
+
+        Each result is a tuple of the value returned and the exception
+        class raised.
+
+        """
+        results = []
+        def call():
+            try:
+                results.append((function(), None))
+            except Exception, e:
+                results.append((None, e.__class__))
+        threads = [threading.Thread(target=call) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def testSingleFlight(self):
+        reads = delicious.ReadCache()
+        self.server.latency = 0.3
+        results = self.concurrently(lambda: self.account(reads).tags())
+        self.assertEqual(self.hits("tags/get"), 1)
+        self.assertEqual(len(results), 5)
+        for (value, error) in results:
+            self.assertEqual((value, error), results[0])
+
+        # Without a ttl nothing is kept once the read has finished.
+        self.account(reads).tags()
+        self.assertEqual(self.hits("tags/get"), 2)
+
+    def testSharedError(self):
+        reads = delicious.ReadCache()
+        (self.server.latency, self.server.throttle) = (0.3, 1)
+        results = self.concurrently(lambda: self.account(reads).tags())
+        self.assertEqual(results, [(None, delicious.ThrottleError)] * 5)
+        shared = self.hits("tags/get")
+        self.server.paths.clear()
+        self.assertRaises(delicious.ThrottleError, self.account(reads).tags)
+        self.assertEqual(self.hits("tags/get"), shared)
+
+    def testExpiry(self):
+        account = self.account(delicious.ReadCache(ttl=0.3))
+        account.tags()
+        account.tags()
+        self.assertEqual(self.hits("tags/get"), 1)
+        time.sleep(0.5)
+        account.tags()
+        self.assertEqual(self.hits("tags/get"), 2)
+
+    def testEviction(self):
+        account = self.account(delicious.ReadCache(size=2, ttl=60))
+        account.tags()
+        account.bundles()
+        account.tags()
+        account.dates()
+        self.assertEqual((self.hits("tags/get"), self.hits("tags/bundles/all"), \
+                self.hits("posts/dates")), (1, 1, 1))
+
+        # The bundles were used least recently so they were discarded.
+        account.tags()
+        account.bundles()
+        self.assertEqual((self.hits("tags/get"), \
+                self.hits("tags/bundles/all")), (1, 2))
+
+    def testChangeDuringRead(self):
+        reads = delicious.ReadCache(ttl=60)
+        self.server.latency = 0.3
+        reader = threading.Thread(target=self.account(reads).tags)
+        reader.start()
+        time.sleep(0.1)
+        self.server.account.add("http://other.example/", "Other", "", "fresh")
+        reads.invalidate("test")
+        reader.join()
+        tags = [tag[u"name"] for tag in self.account(reads).tags()]
+        self.assertEqual(self.hits("tags/get"), 2)
+        self.failUnless(u"fresh" in tags)
+
+
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _mock(5000)
+        self.pool = delicious.ThreadPool(2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def account(self):
+        return delicious.AsyncDeliciousAccount("test", "test", \
+                limiter=_limiter(), pool=self.pool)
+
+    def testHeldStreams(self):
+        # More streams are held part way through than there are workers.
+        streams = []
+        try:
+            for i in range(4):
+                stream = self.account().iterposts(size=10)
+                stream.next()
+                streams.append(stream)
+            self.failUnless(self.account().lastupdate().result(5))
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def testAbandonedStream(self):
+        account = self.account()
+        stream = account.iterposts(size=10)
+        stream.next()
+        del stream
+        gc.collect()
+        self.failUnless(account.lastupdate().result(5))
+
+    def testOrder(self):
+        account = self.account()
+        posts = list(account.iterposts(count=20))
+        self.assertEqual(len(posts), 20)
+        self.assertEqual(len(account.posts(count=5).result(5)), 5)
+
+
+class OutboxTest(TemporaryFiles, unittest.TestCase):
+
+    def setUp(self):
+        TemporaryFiles.setUp(self)
+        if delicious.sqlite3 is None:
+            return
+        self.server = _mock(10)
+        self.path = self.temporary(".db")
+
+    def pending(self, outbox):
+        return [(operation, key, query) for (id, operation, key, path, query) \
+                in outbox.claim("test")]
+
+    def testMerging(self):
+        if delicious.sqlite3 is None:
+            return
+        outbox = delicious.Outbox(self.path)
+        outbox.put("test", "add", "http://a/", "posts/add", {"url": "http://a/"})
+        outbox.put("test", "delete", "http://a/", "posts/delete", \
+                {"url": "http://a/"})
+        outbox.put("test", "bundle", "b", "tags/bundles/set", {"tags": "x"})
+        outbox.put("test", "bundle", "b", "tags/bundles/set", {"tags": "y"})
+        outbox.put("test", "rename_tag", "t", "tags/rename", {"new": "u"})
+        outbox.put("other", "add", "http://a/", "posts/add", {"url": "http://a/"})
+        self.assertEqual(self.pending(outbox), [ \
+                ("delete", "http://a/", {"url": "http://a/"}), \
+                ("bundle", "b", {"tags": "y"}), \
+                ("rename_tag", "t", {"new": "u"})])
+        self.assertEqual(outbox.count("other"), 1)
+        outbox.close()
+
+    def testDrain(self):
+        if delicious.sqlite3 is None:
+            return
+        account = _account(outbox=self.path)
+        account.add("http://a.example/", "A")
+        account.add("http://a.example/", "A2")
+        account.delete("http://example0.com/page/0")
+        account.bundle("b", "x y")
+        self.failUnless(account.flush(10))
+        account.close()
+        self.assertEqual(self.server.account.get("http://a.example/") \
+                ["description"], "A2")
+        self.assertEqual(self.server.account.get("http://example0.com/page/0"), \
+                None)
+        self.assertEqual(self.server.account.bundles, {"b": "x y"})
+
+    def testRecovery(self):
+        if delicious.sqlite3 is None:
+            return
+
+        # A process that stopped part way through left a change claimed.
+        stopped = delicious.Outbox(self.path, lease=0.5)
+        stopped.put("test", "delete", "http://example1.com/page/1", \
+                "posts/delete", {"url": "http://example1.com/page/1"})
+        self.assertEqual(len(stopped.claim("test")), 1)
+
+        # Another process leaves it alone until its lease runs out.
+        outbox = delicious.Outbox(self.path)
+        outbox.recover("test")
+        self.assertEqual(outbox.claim("test"), [])
+        time.sleep(0.6)
+        account = _account(outbox=outbox)
+        self.failUnless(account.flush(10))
+        account.close()
+        self.assertEqual(self.server.account.get("http://example1.com/page/1"), \
+                None)
+        self.assertEqual(self.server.paths["/v1/posts/delete"], 1)
+        stopped.close()
+        outbox.close()
+
+    def testClosed(self):
+        if delicious.sqlite3 is None:
+            return
+        account = _account(outbox=self.path)
+        account.close()
+        self.assertRaises(delicious.DeliciousError, account.add, \
+                "http://a.example/", "A")
+
+    def testDrainerSurvivesErrors(self):
+        if delicious.sqlite3 is None:
+            return
+        outbox = delicious.Outbox(self.path)
+        claim = outbox.claim
+        failures = []
+        def failing(username):
+            if not failures:
+                failures.append(1)
+                raise delicious.sqlite3.OperationalError("database is locked")
+            return claim(username)
+        outbox.claim = failing
+        account = _account(outbox=outbox)
+        account.add("http://a.example/", "A")
+        self.failUnless(account.flush(10))
+        self.failUnless(failures)
+        self.failUnless(self.server.account.get("http://a.example/"))
+        account.close()
+        outbox.close()
+
+    def testDeadDrainer(self):
+        if delicious.sqlite3 is None:
+            return
+        account = _account(outbox=self.path)
+        drainer = account._DeliciousAccount__drainer
+        drainer.stop()
+        drainer.join()
+        account.outbox.put("test", "delete", "http://a/", "posts/delete", \
+                {"url": "http://a/"})
+        self.assertRaises(delicious.DeliciousError, account.flush)
+        account.close()
+
+
+if __name__ == "__main__":
+    unittest.main()